@@ -15,7 +15,7 @@
 # ------------------------------------------------------------------------------
 
 
-KNOWN_INTERFACES = ['simple', 'taridx', 'redis']
+KNOWN_INTERFACES = ['simple', 'taridx', 'taridx-sharded', 'redis', 'redis-async']
 
 
 def get_interfaces():
@@ -31,10 +31,18 @@ def get_io(_):
         from .tar import IO_Tar
         interface = IO_Tar
 
+    elif _ == 'taridx-sharded':
+        from .tar_sharded import IO_TarSharded
+        interface = IO_TarSharded
+
     elif _ == 'redis':
         from .redis import IO_Redis
         interface = IO_Redis
 
+    elif _ == 'redis-async':
+        from .redis_async import IO_RedisAsync
+        interface = IO_RedisAsync
+
     else:
         raise ValueError(f'Invalid IO interface requested ({_})')
 
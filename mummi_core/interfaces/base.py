@@ -18,8 +18,13 @@ import time
 import datetime
 import shutil
 import glob
+import fnmatch
+import re
+import threading
 from abc import ABC, abstractmethod
-from .default_functions import write_npz, read_npz
+from concurrent.futures import ThreadPoolExecutor
+from .default_functions import write_npz, read_npz, read_npz_lazy
+from .codecs import compress, decompress
 
 LOGGER = logging.getLogger(__name__)
 
@@ -40,11 +45,38 @@ def check_filename(namespace, filename):
         return namespace
 
 
+def scan_files(path, keypattern='*', hidden=False):
+    # returns the set of names of the files in path that match keypattern, in
+    # one pass over the directory instead of a stat per file. like glob, hidden
+    # files only match patterns that start with a '.' (or with hidden, which
+    # lookups of exact names use)
+    match = re.compile(fnmatch.translate(keypattern)).match
+    hidden = hidden or keypattern.startswith('.')
+    try:
+        with os.scandir(path) as entries:
+            return set(e.name for e in entries
+                       if (hidden or not e.name.startswith('.')) and match(e.name) and e.is_file())
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
 # ------------------------------------------------------------------------------
 # Abstract class for I/O interfaces
 # ------------------------------------------------------------------------------
 class IO_Base(ABC):
 
+    # number of threads used by interfaces that run independent I/O concurrently
+    MAX_WORKERS = 8
+
+    # compress stored values of at least CODEC_THRESHOLD bytes with CODEC
+    # (any of codecs.get_codecs(), or None to store values as they are)
+    CODEC = None
+    CODEC_THRESHOLD = 4096
+
+    # one thread pool per interface, shared by the whole process
+    _EXECUTORS = {}
+    _EXECUTORS_LOCK = threading.Lock()
+
     # --------------------------------------------------------------------------
     # Public Abstract functions
     # --------------------------------------------------------------------------
@@ -63,6 +95,10 @@ class IO_Base(ABC):
     def file_exists(cls, namespace, key):
         raise NotImplementedError('Abstract method should be implemented by child class')
 
+    @classmethod
+    def files_exist(cls, namespace, keys):
+        return [cls.file_exists(namespace, k) for k in keys]
+
     @classmethod
     @abstractmethod
     def namespace_exists(cls, namespace):
@@ -73,7 +109,7 @@ class IO_Base(ABC):
     # --------------------------------------------------------------------------
     @classmethod
     @abstractmethod
-    def _list_keys(cls, namespace, keypattern):
+    def _list_keys(cls, namespace, keypattern, max_keys=None):
         raise NotImplementedError('Abstract method should be implemented by child class')
 
     @classmethod
@@ -100,9 +136,9 @@ class IO_Base(ABC):
     # Public interface
     # --------------------------------------------------------------------------
     @classmethod
-    def list_keys(cls, namespace, keypattern):
+    def list_keys(cls, namespace, keypattern, max_keys=None):
 
-        keys = cls._list_keys(namespace, keypattern)
+        keys = cls._list_keys(namespace, keypattern, max_keys)
         keys = [os.path.basename(k) for k in keys]
         return list(set(keys))
 
@@ -117,14 +153,24 @@ class IO_Base(ABC):
     def load_files(cls, namespace, filenames):
 
         if isinstance(filenames, list):
-            return cls._load_files(namespace, filenames)
+            data = cls._load_files(namespace, filenames)
+            return data if data is None else [cls._decode(d) for d in data]
 
         if isinstance(filenames, str):
-            return cls._load_files(namespace, [filenames])[0]
+            return cls._decode(cls._load_files(namespace, [filenames])[0])
 
         raise ValueError(f'Incorrect arguments (keys={type(keys)}). '
                          f'Need a filename or a list of filenames')
 
+    @classmethod
+    def load_files_partial(cls, namespace, filenames):
+        # loads the keys that exist, and returns (data, missing keys), where
+        # data has None in place of each missing key
+        assert isinstance(filenames, list)
+        data = cls._load_files_partial(namespace, filenames)
+        missing = [k for k, d in zip(filenames, data) if d is None]
+        return [d if d is None else cls._decode(d) for d in data], missing
+
     @classmethod
     def save_files(cls, namespace, keys, data):
 
@@ -153,17 +199,21 @@ class IO_Base(ABC):
                          f'Need a filename or a list of filenames')
 
     @classmethod
-    def load_npz(cls, namespace, keys, reader_func=read_npz):
+    def load_npz(cls, namespace, keys, reader_func=read_npz, lazy=False):
 
         if isinstance(keys, list):
             keys = [check_extn(k, '.npz') for k in keys]
             data = cls._load_files(namespace, keys)
-            return [reader_func(io.BytesIO(d)) for d in data]
+            if lazy:
+                return [read_npz_lazy(cls._decode(d)) for d in data]
+            return [reader_func(io.BytesIO(cls._decode(d))) for d in data]
 
         elif isinstance(keys, str):
             keys = check_extn(keys, '.npz')
             data = cls._load_files(namespace, [keys])[0]
-            return reader_func(io.BytesIO(data))
+            if lazy:
+                return read_npz_lazy(cls._decode(data))
+            return reader_func(io.BytesIO(cls._decode(data)))
 
         raise ValueError(f'Incorrect arguments (keys={type(keys)}). '
                          f'Need a filename or a list of filenames')
@@ -191,11 +241,25 @@ class IO_Base(ABC):
     def _encode(cls, _):
         # TODO: additional types
         if isinstance(_, bytes):
-            return _
+            return compress(_, cls.CODEC, cls.CODEC_THRESHOLD)
         if isinstance(_, str):
-            return _.encode('utf-8')
+            return compress(_.encode('utf-8'), cls.CODEC, cls.CODEC_THRESHOLD)
         raise Exception(f'Unhandled data type {type(_)}')
 
+    @classmethod
+    def _decode(cls, _):
+        return decompress(_)
+
+    @classmethod
+    def _load_files_partial(cls, namespace, filenames):
+        # interfaces whose _load_files fails a whole batch on a missing key
+        # override this to load the rest in the same pass
+        data = cls._load_files(namespace, filenames)
+        if data is None:
+            data = [cls._load_files(namespace, [k]) for k in filenames]
+            data = [d if d is None else d[0] for d in data]
+        return data
+
     @classmethod
     def _wmode(cls, _):
         # TODO: additional types
@@ -205,6 +269,22 @@ class IO_Base(ABC):
             return 'w'
         raise Exception(f'Unhandled file mode {type(_)}')
 
+    @classmethod
+    def _get_executor(cls):
+        with IO_Base._EXECUTORS_LOCK:
+            executor = IO_Base._EXECUTORS.get(cls)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=cls.MAX_WORKERS,
+                                              thread_name_prefix=cls.__name__)
+                IO_Base._EXECUTORS[cls] = executor
+            return executor
+
+    @classmethod
+    def _reset_executors(cls):
+        # threads do not survive a fork, so children start new pools
+        IO_Base._EXECUTORS = {}
+        IO_Base._EXECUTORS_LOCK = threading.Lock()
+
     @classmethod
     def take_backup(cls, filename, suffix=None):
         if os.path.isfile(filename):
@@ -293,4 +373,14 @@ class IO_Base(ABC):
             LOGGER.debug(f"Found signal {signal}")
         return os.path.isfile(signal)
 
+    @classmethod
+    def test_signals(cls, path, keys):
+        # returns the set of keys whose signals exist, reading path only once
+        found = scan_files(path, hidden=True) & set(keys)
+        LOGGER.debug(f"Found signals {sorted(found)} in {path}")
+        return found
+
+
+os.register_at_fork(after_in_child=IO_Base._reset_executors)
+
 # --------------------------------------------------------------------------
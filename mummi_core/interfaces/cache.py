@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2021, Lawrence Livermore National Security, LLC. All rights
+# reserved. LLNL-CODE-827197. This work was produced at the Lawrence Livermore
+# National Laboratory (LLNL) under contract no. DE-AC52-07NA27344 (Contract 44)
+# between the U.S. Department of Energy (DOE) and Lawrence Livermore National
+# Security, LLC (LLNS) for the operation of LLNL.  See license for disclaimers,
+# notice of U.S. Government Rights and license terms and conditions.
+# -----------------------------------------------------------------------------
+
+import os
+import time
+import hashlib
+import tempfile
+from logging import getLogger
+from filelock import FileLock, Timeout
+
+LOGGER = getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+# Size-bounded, least-recently-used cache of values in a local directory
+# Entries are written atomically (temporary file + rename), so any number of
+# processes on a node can share the cache. Eviction is done by one process at a
+# time, under a file lock.
+# Removing a key also grows a marker file next to its entry, so that a value
+# fetched before the removal is not put back (see markers and put).
+# ------------------------------------------------------------------------------
+class LocalCache:
+
+    # markers older than this (in seconds) are dropped by evict
+    MARKER_AGE = 600
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = FileLock(os.path.join(path, '.lock'))
+        self.written = max_bytes    # make the first put check the total size
+        os.makedirs(path, exist_ok=True)
+
+    def __str__(self):
+        return f'LocalCache ({self.path}; {self.max_bytes} bytes)'
+
+    def get(self, keys):
+        keys_to_data = {}
+        for key in keys:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as fp:
+                    keys_to_data[key] = fp.read()
+                os.utime(path)      # mark as recently used
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                LOGGER.warning(f'Failed to read ({key}) from {self}: {e}')
+        return keys_to_data
+
+    def markers(self, keys):
+        # returns the state of the removal markers of keys, to be passed to put
+        # for values fetched after this call
+        return {key: self._marker(key) for key in keys}
+
+    def put(self, keys_to_data, markers=None):
+        # with markers, keys removed since the markers were taken are skipped
+        for key, data in keys_to_data.items():
+            if markers is not None and self._marker(key) != markers.get(key):
+                continue
+            path = self._path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(data)
+                os.replace(tmp, path)
+                self.written += len(data)
+
+                # a removal between the check and the rename has either
+                # deleted the entry already, or changed the marker
+                if markers is not None and self._marker(key) != markers.get(key):
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                LOGGER.warning(f'Failed to write ({key}) to {self}: {e}')
+
+        # check the total size only once a tenth of the cache has been written
+        if self.written >= self.max_bytes // 10:
+            self.evict()
+
+    def remove(self, keys):
+        for key in keys:
+            path = self._path(key)
+            try:
+                # the marker changes before the entry goes away
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f'{path}.removed', 'ab') as fp:
+                    fp.write(b'.')
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                LOGGER.warning(f'Failed to remove ({key}) from {self}: {e}')
+
+    def evict(self):
+        try:
+            with self.lock.acquire(timeout=0):
+                self.written = 0
+                entries, markers = [], []
+                for subdir in os.scandir(self.path):
+                    if subdir.is_dir():
+                        for e in os.scandir(subdir.path):
+                            if not e.is_file():
+                                continue
+                            if e.name.endswith('.removed'):
+                                markers.append((e.stat().st_mtime, e.path))
+                            else:
+                                entries.append((e.stat().st_mtime, e.stat().st_size, e.path))
+
+                # markers are only needed while a fetch may still be running
+                for mtime, path in markers:
+                    if time.time() - mtime > self.MARKER_AGE:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+
+                total = sum(e[1] for e in entries)
+                if total <= self.max_bytes:
+                    return
+
+                # drop the least recently used entries down to 90% of the limit
+                for _, size, path in sorted(entries):
+                    if total <= 0.9 * self.max_bytes:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                    except FileNotFoundError:
+                        pass
+                LOGGER.debug(f'Evicted {self} down to {total} bytes')
+
+        except Timeout:
+            pass    # another process is evicting
+
+    def _marker(self, key):
+        try:
+            st = os.stat(f'{self._path(key)}.removed')
+            return st.st_ino, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def _path(self, key):
+        h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, h[:2], h)
+
+# ------------------------------------------------------------------------------
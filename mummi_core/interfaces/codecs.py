@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2021, Lawrence Livermore National Security, LLC. All rights
+# reserved. LLNL-CODE-827197. This work was produced at the Lawrence Livermore
+# National Laboratory (LLNL) under contract no. DE-AC52-07NA27344 (Contract 44)
+# between the U.S. Department of Energy (DOE) and Lawrence Livermore National
+# Security, LLC (LLNS) for the operation of LLNL.  See license for disclaimers,
+# notice of U.S. Government Rights and license terms and conditions.
+# -----------------------------------------------------------------------------
+
+# ------------------------------------------------------------------------------
+# Compression codecs for stored values
+# A compressed value is HEADER + codec id (1 byte) + compressed bytes. Values
+# without the header are returned as is, so uncompressed data remains readable.
+# ------------------------------------------------------------------------------
+
+import lzma
+import zlib
+from logging import getLogger
+
+LOGGER = getLogger(__name__)
+
+HEADER = b'\x89MUMMI\x00'
+
+# ids are written into the data, so they must never change
+CODEC_IDS = {'zlib': 1, 'lzma': 2, 'lz4': 3, 'zstd': 4}
+
+# name: (compress, decompress) for the codecs available in this environment
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+try:
+    import lz4.frame
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    CODECS['zstd'] = (lambda d: zstandard.ZstdCompressor().compress(d),
+                      lambda d: zstandard.ZstdDecompressor().decompress(d))
+except ImportError:
+    pass
+
+
+# ------------------------------------------------------------------------------
+def get_codecs():
+    return list(CODECS.keys())
+
+
+def compress(data, codec, threshold=0):
+    # small values, and values that do not shrink, are stored uncompressed
+    if codec is None or len(data) < threshold:
+        return data
+
+    if codec not in CODECS:
+        raise ValueError(f'Unavailable codec ({codec}). Available: {get_codecs()}')
+
+    cdata = HEADER + bytes([CODEC_IDS[codec]]) + CODECS[codec][0](data)
+    return cdata if len(cdata) < len(data) else data
+
+
+def decompress(data):
+    if data is None or data[:len(HEADER)] != HEADER:
+        return data
+
+    cid = data[len(HEADER)]
+    codec = [k for k, v in CODEC_IDS.items() if v == cid]
+    if len(codec) == 0 or codec[0] not in CODECS:
+        raise ValueError(f'Cannot decompress data with unavailable codec ({codec or cid})')
+
+    return CODECS[codec[0]][1](data[len(HEADER) + 1:])
+
+# ------------------------------------------------------------------------------
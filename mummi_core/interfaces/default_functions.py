@@ -10,6 +10,9 @@
 # -----------------------------------------------------------------------------
 
 import io
+import struct
+import zipfile
+from collections.abc import Mapping
 import numpy as np
 
 
@@ -29,6 +32,89 @@ def read_npz(file):
     return data
 
 
+def read_npz_lazy(buffer):
+    # returns a read-only mapping over an npz archive in buffer (e.g., bytes or
+    # memoryview), which reads each array only when it is accessed. arrays
+    # stored without compression are views of buffer (no copies)
+    return NpzLazy(buffer)
+
+
+class NpzLazy(Mapping):
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast('B')
+        self.zip = zipfile.ZipFile(_BufferIO(self.buffer))
+        self.files = [n[:-4] for n in self.zip.namelist() if n.endswith('.npy')]
+        self.arrays = {}
+
+    def __getitem__(self, key):
+        if key not in self.arrays:
+            if key not in self.files:
+                raise KeyError(f'{key} is not a file in the archive')
+            self.arrays[key] = self._read(self.zip.getinfo(key + '.npy'))
+        return self.arrays[key]
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def _read(self, info):
+        if info.compress_type == zipfile.ZIP_STORED:
+            # the member follows its local header (30 bytes, name and extra)
+            fname_len, extra_len = struct.unpack('<HH', self.buffer[info.header_offset + 26:
+                                                                    info.header_offset + 30])
+            start = info.header_offset + 30 + fname_len + extra_len
+            npy = self.buffer[start:start + info.file_size]
+
+            fp = _BufferIO(npy)
+            version = np.lib.format.read_magic(fp)
+            dtype = np.dtype(object)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+            if not dtype.hasobject:
+                count = int(np.prod(shape, dtype=np.int64))
+                array = np.frombuffer(npy, dtype=dtype, count=count, offset=fp.tell())
+                return array.reshape(shape, order='F' if fortran_order else 'C')
+
+        with self.zip.open(info) as fp:
+            return np.lib.format.read_array(fp, allow_pickle=True)
+
+
+class _BufferIO(io.RawIOBase):
+    # a seekable file over a buffer, which (unlike io.BytesIO) does not copy it
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.buffer) - self.pos))
+        b[:n] = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
 def write_string(file, data):
     # assert isinstance(file, str)
     # assert isinstance(data, str)
@@ -11,21 +11,69 @@
 
 import os
 import io
+import bisect
+import fnmatch
+import functools
+import hashlib
+import itertools
 import random
+import threading
+import time
 import redis
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from logging import getLogger
 from filelock import FileLock
 from collections import defaultdict
 
 from mummi_core.utils import Naming
 from .base import IO_Base
+from .cache import LocalCache
 from .default_functions import read_npz
 
 LOGGER = getLogger(__name__)
 
+# renames KEYS[i] to KEYS[n+i] for the first n keys that exist, and returns the
+# (1-based) indices of the renamed keys
+RENAME_SCRIPT = '''
+local n = #KEYS / 2
+local renamed = {}
+for i = 1, n do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[n + i])
+        renamed[#renamed + 1] = i
+    end
+end
+return renamed
+'''
+
+
+# ------------------------------------------------------------------------------
+# Consistent-hash ring of servers (used by IO_Redis.SHARDING)
+# each server is placed at several virtual points, so that adding a server
+# only moves the keys that now fall onto its points
+# ------------------------------------------------------------------------------
+class HashRing:
+
+    def __init__(self, servers, vnodes):
+        self.servers = tuple(servers)
+        self.vnodes = vnodes
+        points = sorted((self.hash(f'{s}#{i}'), s) for s in self.servers for i in range(vnodes))
+        self.points = [p for p, _ in points]
+        self.owners = [s for _, s in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def get_server(self, key):
+        if len(self.points) == 0:
+            raise Exception('Cannot shard keys without any servers')
+        i = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[i]
+
 
 # ------------------------------------------------------------------------------
-# Tar Interface
+# Redis Interface
 # ------------------------------------------------------------------------------
 class IO_Redis (IO_Base):
 
@@ -34,6 +82,62 @@ class IO_Redis (IO_Base):
     LOCAL_SERVER_TXT = os.path.join(TMP_DIR, 'server.txt')
     ALL_SERVERS_TXT = os.path.join(Naming.dir_root('redis'), 'all_servers.txt')
 
+    # how bind_local_redis picks the server to write to: 'random',
+    # 'least-loaded' (by the memory and clients reported by INFO), or 'closest'
+    # (by round-trip time). a binding older than BIND_INTERVAL seconds is
+    # re-evaluated (None keeps it for good)
+    BIND_POLICY = 'random'
+    BIND_INTERVAL = None
+
+    # number of keys sent to a server in a single round trip
+    BATCH_SIZE = 1000
+    # number of keys a server walks per SCAN call when listing keys
+    SCAN_COUNT = 1000
+
+    # all servers are queried concurrently (on MAX_WORKERS threads), and any
+    # server that does not answer within SERVER_TIMEOUT seconds of its query
+    # starting is skipped
+    MAX_WORKERS = 16
+    SERVER_TIMEOUT = 10
+
+    # place each key on a consistent-hash ring of all servers (instead of on the
+    # server bound by bind_local_redis), so reads go straight to its owner
+    SHARDING = False
+    SHARD_VNODES = 128
+    # keys missing at their owner (e.g., written before sharding was enabled
+    # or before a server was added) are looked for on all servers
+    SHARD_FALLBACK = True
+
+    # without sharding, writers record the server of each key in a directory
+    # (a hash per namespace on DIRECTORY_SERVER, by default the first server
+    # listed), so readers can skip the servers that do not have the key
+    LOCATION_INDEX = False
+    DIRECTORY_SERVER = None
+
+    # keep up to CACHE_SIZE bytes of loaded values on the local disk (0 to
+    # disable), for both IO_Redis and IO_RedisAsync. values saved or removed
+    # through this node are dropped from it (and not cached again by a load
+    # that was already running)
+    CACHE_SIZE = 0
+    CACHE_DIR = os.path.join(TMP_DIR, 'cache')
+
+    # announce saved keys on a stream per namespace (kept on each server, and
+    # trimmed to about STREAM_MAXLEN entries), which watch_keys follows
+    NOTIFY = False
+    STREAM_MAXLEN = 100000
+
+    # keys moved to tar archives (see utils.tier_to_tar) are looked for in the
+    # archives listed for their namespace on the directory server (which costs
+    # a round trip to it on every load that misses a key)
+    TIER_FALLBACK = False
+
+    # process-wide state, shared by all users of IO_Redis (see _reset_state)
+    _POOLS = {}
+    _POOLS_LOCK = threading.Lock()
+    _FILE_CACHE = {}
+    _RING = None
+    _CACHE = None
+
     # --------------------------------------------------------------------------
     # Public Abstract functions
     # --------------------------------------------------------------------------
@@ -50,14 +154,43 @@ class IO_Redis (IO_Base):
         assert isinstance(namespace, str) and isinstance(key, str)
         redis_key = cls._format_redis_key(namespace, key)
         try:
-            conns = cls._get_remote_connections()
-            for conn in conns:
-                if conn.exists(redis_key):
+            for server in cls._locate_keys(namespace, [key]):
+                if cls._get_remote_connection(server).exists(redis_key):
                     return True
+            if not cls._probe_on_miss():
+                return False
+
+            exists = cls._map_servers(lambda s: cls._get_remote_connection(s).exists(redis_key),
+                                      cls._get_all_servers())
+            return any(exists.values())
         except Exception as e:
             LOGGER.error(f'Failed to check file exists: {e}')
         return False
 
+    @classmethod
+    def files_exist(cls, namespace, keys):
+        assert isinstance(namespace, str) and isinstance(keys, list)
+        exists = dict.fromkeys(keys, False)
+        try:
+            servers_to_keys = cls._locate_keys(namespace, keys)
+            if len(servers_to_keys) > 0:
+                servers_to_found = cls._map_servers(
+                    lambda s: cls._files_exist_at_server(namespace, servers_to_keys[s], s),
+                    servers_to_keys)
+                for found in servers_to_found.values():
+                    exists.update(dict.fromkeys(found, True))
+
+            remaining_keys = [k for k in keys if not exists[k]]
+            if len(remaining_keys) > 0 and cls._probe_on_miss():
+                servers_to_found = cls._map_servers(
+                    lambda s: cls._files_exist_at_server(namespace, remaining_keys, s),
+                    cls._get_all_servers())
+                for found in servers_to_found.values():
+                    exists.update(dict.fromkeys(found, True))
+        except Exception as e:
+            LOGGER.error(f'Failed to check files exist: {e}')
+        return [exists[k] for k in keys]
+
     @classmethod
     def namespace_exists(cls, namespace):
         raise Exception('IO_Redis does not have namespace_exists')
@@ -68,13 +201,29 @@ class IO_Redis (IO_Base):
     # Private Abstract functions
     # --------------------------------------------------------------------------
     @classmethod
-    def _list_keys(cls, namespace, keypattern):
-        servers_to_keys = cls.list_servers_to_keys(namespace, keypattern)
-        return [k for d in servers_to_keys.values() for k in d]
+    def _list_keys(cls, namespace, keypattern, max_keys=None):
+        if max_keys is None:
+            servers_to_keys = cls.list_servers_to_keys(namespace, keypattern)
+            return [k for d in servers_to_keys.values() for k in d]
+        return list(itertools.islice(cls.iter_keys(namespace, keypattern), max_keys))
 
     @classmethod
     def _move_key(cls, namespace, old, new):
-        raise Exception('IO_Redis cannot currently move keys')
+        LOGGER.debug(f'moving ({old}) to ({new}) in namespace ({namespace})')
+        old_key = cls._format_redis_key(namespace, old)
+        new_key = cls._format_redis_key(namespace, new)
+
+        servers = list(cls._locate_keys(namespace, [old]))
+        if cls._probe_on_miss():
+            servers += [s for s in cls._get_all_servers() if s not in servers]
+        for server in servers:
+            if len(cls._rename_at_server(server, [old_key], [new_key])) > 0:
+                cls._uncache(namespace, [old, new])
+                if cls.LOCATION_INDEX:
+                    cls._forget_locations(namespace, [old])
+                    cls._record_locations(namespace, [new], server)
+                return
+        raise Exception(f'Key ({old}) does not exist in ({namespace})')
 
     @classmethod
     def _load_files(cls, namespace, keys):
@@ -83,38 +232,104 @@ class IO_Redis (IO_Base):
         idxs = {k: v for v, k in enumerate(keys)}
         remaining_keys = keys
         servers = cls._get_all_servers()
-        for server in servers:
-            keys_to_data = cls._load_files_at_server(namespace, remaining_keys, server)
-            remaining_keys = [k for k in remaining_keys if not k in keys_to_data]
+
+        # values cached on this node need no server at all
+        cache = cls._get_cache()
+        if cache is not None:
+            keys_to_data = cache.get([cls._format_redis_key(namespace, k) for k in keys])
+            for k in keys:
+                d = keys_to_data.get(cls._format_redis_key(namespace, k))
+                if d is not None:
+                    data[idxs[k]] = d
+            remaining_keys = [k for k in keys if data[idxs[k]] is None]
+
+            # taken before the fetch, so that keys removed meanwhile are not cached
+            markers = cache.markers([cls._format_redis_key(namespace, k) for k in remaining_keys])
+        uncached_keys = remaining_keys
+
+        # then, go straight to the servers known to own the keys
+        servers_to_keys = cls._locate_keys(namespace, remaining_keys)
+        if len(servers_to_keys) > 0:
+            servers_to_data = cls._map_servers(
+                lambda s: cls._load_files_at_server(namespace, servers_to_keys[s], s),
+                servers_to_keys)
+            for keys_to_data in servers_to_data.values():
+                for k in keys_to_data:
+                    data[idxs[k]] = keys_to_data[k]
+            remaining_keys = [k for k in remaining_keys if data[idxs[k]] is None]
+        if not cls._probe_on_miss():
+            servers = []
+
+        if len(remaining_keys) > 0 and len(servers) > 0:
+            # ask every server at once, and keep the first hit in server order
+            servers_to_data = cls._map_servers(
+                lambda s: cls._load_files_at_server(namespace, remaining_keys, s), servers)
+            for keys_to_data in servers_to_data.values():
+                for k in keys_to_data:
+                    if data[idxs[k]] is None:
+                        data[idxs[k]] = keys_to_data[k]
+            remaining_keys = [k for k in remaining_keys if data[idxs[k]] is None]
+
+        if len(remaining_keys) > 0 and cls.TIER_FALLBACK:
+            keys_to_data = cls._load_files_from_tiers(namespace, remaining_keys)
             for k in keys_to_data:
                 data[idxs[k]] = keys_to_data[k]
+            remaining_keys = [k for k in remaining_keys if data[idxs[k]] is None]
+
+        if cache is not None:
+            cache.put({cls._format_redis_key(namespace, k): data[idxs[k]]
+                       for k in uncached_keys if data[idxs[k]] is not None}, markers)
         LOGGER.debug(f'Loaded {len(keys)-len(remaining_keys)} out of {len(keys)} ' +
                      f'keys across {len(servers)} servers')
         return data
 
     @classmethod
     def _load_files_at_server(cls, namespace, keys, server):
+        keys_to_data = {}
         try:
-            keys_to_data = {}
-            conn = IO_Redis._get_remote_connection(server)
-            for key in keys:
-                redis_key = cls._format_redis_key(namespace, key)
-                if conn.exists(redis_key):
-                    keys_to_data[key] = conn.get(redis_key)
-            return keys_to_data
+            conn = cls._get_remote_connection(server)
+            for chunk in cls._chunks(keys):
+                redis_keys = [cls._format_redis_key(namespace, k) for k in chunk]
+                for key, d in zip(chunk, conn.mget(redis_keys)):
+                    if d is not None:
+                        keys_to_data[key] = d
         except Exception as e:
             LOGGER.error(f'Failed to load files at {server}: {e}')
+        return keys_to_data
+
+    @classmethod
+    def _files_exist_at_server(cls, namespace, keys, server):
+        # returns the keys that exist at server
+        found = []
+        conn = cls._get_remote_connection(server)
+        for chunk in cls._chunks(keys):
+            pipe = conn.pipeline(transaction=False)
+            for key in chunk:
+                pipe.exists(cls._format_redis_key(namespace, key))
+            found.extend(k for k, n in zip(chunk, pipe.execute()) if n)
+        return found
 
     @classmethod
     def _save_files(cls, namespace, keys, data):
 
         LOGGER.debug(f'Writing {len(keys)} files to ({namespace})')
         try:
-            conn = IO_Redis._get_local_connection()
-            for i, fname in enumerate(keys):
-                redis_key = cls._format_redis_key(namespace, fname)
-                d = cls._encode(data[i])
-                conn.set(redis_key, d)
+            if cls.SHARDING:
+                keys_to_data = dict(zip(keys, data))
+                servers_to_keys = cls._group_by_shard(namespace, keys)
+                for server, skeys in servers_to_keys.items():
+                    conn = cls._get_remote_connection(server)
+                    cls._save_files_at_conn(conn, namespace, skeys,
+                                            [keys_to_data[k] for k in skeys])
+                cls._uncache(namespace, keys)
+                LOGGER.info(f'Wrote {len(keys)} files across {len(servers_to_keys)} servers')
+                return True
+
+            conn = cls._get_local_connection()
+            cls._save_files_at_conn(conn, namespace, keys, data)
+            cls._uncache(namespace, keys)
+            if cls.LOCATION_INDEX:
+                cls._record_locations(namespace, keys, cls._get_local_server()[0])
             LOGGER.info(f'Wrote {len(keys)} files to server {conn.connection_pool.connection_kwargs["host"]}')
             return True
         except Exception as e:
@@ -126,47 +341,95 @@ class IO_Redis (IO_Base):
 
         remaining_keys = keys
         servers = cls._get_all_servers()
-        for server in servers:
-            keys_to_data = cls.remove_files_at_server(namespace, remaining_keys, server)
-            remaining_keys = [k for k in remaining_keys if not k in keys_to_data]
+        counts = defaultdict(int)
+
+        servers_to_keys = cls._locate_keys(namespace, keys)
+        if len(servers_to_keys) > 0:
+            servers_to_removed = cls._map_servers(
+                lambda s: cls.remove_files_at_server(namespace, servers_to_keys[s], s),
+                servers_to_keys)
+            for server, removed in servers_to_removed.items():
+                counts[server] += len(removed)
+            removed = set(k for d in servers_to_removed.values() for k in d)
+            remaining_keys = [k for k in keys if not k in removed]
+        if not cls._probe_on_miss():
+            servers = []
+
+        if len(remaining_keys) > 0 and len(servers) > 0:
+            servers_to_removed = cls._map_servers(
+                lambda s: cls.remove_files_at_server(namespace, remaining_keys, s), servers)
+            for server, removed in servers_to_removed.items():
+                counts[server] += len(removed)
+            removed = set(k for d in servers_to_removed.values() for k in d)
+            remaining_keys = [k for k in remaining_keys if not k in removed]
 
         LOGGER.debug(f'Removed {len(keys) - len(remaining_keys)} out of {len(keys)} keys ' +
-                     f'across {len(servers)} servers')
+                     f'across {len(servers)} servers: {dict(counts)}')
+        remaining_keys = set(remaining_keys)
+        return [k not in remaining_keys for k in keys]
 
     @classmethod
     def remove_files_at_server(cls, namespace, keys, server):
+        removed = []
         try:
-            conn = IO_Redis._get_remote_connection(server)
-            count = 0
-            for key in keys:
-                redis_key = cls._format_redis_key(namespace, key)
-                if conn.exists(redis_key):
-                    conn.delete(redis_key)
-                    count += 1
-            LOGGER.debug(f'Deleted {count} out of {len(keys)} keys at {server}')
+            conn = cls._get_remote_connection(server)
+            for chunk in cls._chunks(keys):
+                # UNLINK frees the memory in the background, and MULTI/EXEC
+                # applies the whole chunk at once
+                pipe = conn.pipeline(transaction=True)
+                for key in chunk:
+                    pipe.unlink(cls._format_redis_key(namespace, key))
+                removed.extend(k for k, n in zip(chunk, pipe.execute()) if n)
+            cls._uncache(namespace, removed)
+            if cls.LOCATION_INDEX:
+                cls._forget_locations(namespace, removed)
+            LOGGER.debug(f'Deleted {len(removed)} out of {len(keys)} keys at {server}')
         except Exception as e:
             LOGGER.error(f'Failed to delete keys in {namespace} at {server}: {e}')
+        return removed
 
     @classmethod
     def rename_files_at_server(cls, old_namespace, new_namespace, keys, server):
 
+        renamed = []
         try:
-            conn = IO_Redis._get_remote_connection(server)
-            count = 0
-            for key in keys:
-                old_key = cls._format_redis_key(old_namespace, key)
-                new_key = cls._format_redis_key(new_namespace, key)
-                if conn.exists(old_key):
-                    conn.rename(old_key, new_key)
-                    count += 1
-            LOGGER.info(f'Renamed {count} out of {len(keys)} keys '
+            idxs = cls._rename_at_server(server,
+                                         [cls._format_redis_key(old_namespace, k) for k in keys],
+                                         [cls._format_redis_key(new_namespace, k) for k in keys])
+            renamed = [keys[i] for i in idxs]
+            cls._uncache(old_namespace, renamed)
+            cls._uncache(new_namespace, renamed)
+            if cls.LOCATION_INDEX:
+                cls._forget_locations(old_namespace, renamed)
+                cls._record_locations(new_namespace, renamed, server)
+            LOGGER.info(f'Renamed {len(renamed)} out of {len(keys)} keys '
                         f'from {old_namespace} to {new_namespace} at {server}')
         except Exception as e:
             LOGGER.error(f'Failed to rename keys in {old_namespace} at {server}: {e}')
+        return renamed
+
+    @classmethod
+    def rename_files(cls, old_namespace, new_namespace, keys):
+        # moves keys to another namespace on all servers, and returns the
+        # number of keys renamed at each server
+        servers_to_renamed = cls._map_servers(
+            lambda s: cls.rename_files_at_server(old_namespace, new_namespace, keys, s),
+            cls._get_all_servers())
+        return {s: len(renamed) for s, renamed in servers_to_renamed.items()}
 
     # --------------------------------------------------------------------------
     # IO_Redis Public Functions
     # --------------------------------------------------------------------------
+    @classmethod
+    def record_tier(cls, namespace, archive):
+        # lists a tar archive that holds keys of namespace moved out of redis
+        cls._get_directory_connection().sadd(cls._format_tier_key(namespace), archive)
+
+    @classmethod
+    def get_tiers(cls, namespace):
+        archives = cls._get_directory_connection().smembers(cls._format_tier_key(namespace))
+        return sorted(a.decode('utf-8') for a in archives)
+
     @classmethod
     def bind_global_redis(cls, hostname, port):
         wspace_redis = Naming.dir_root('redis')
@@ -181,7 +444,7 @@ class IO_Redis (IO_Base):
             raise e
 
     @classmethod
-    def bind_local_redis(cls):
+    def bind_local_redis(cls, rebind=False):
         wspace_redis = Naming.dir_root('redis')
 
         if not os.path.isfile(cls.ALL_SERVERS_TXT):
@@ -198,15 +461,19 @@ class IO_Redis (IO_Base):
 
                 # Re-use connections to reduce network bandwidth
                 reuse_connection = False
-                if os.path.exists(cls.LOCAL_SERVER_TXT):
+                if os.path.exists(cls.LOCAL_SERVER_TXT) and not rebind \
+                        and not cls._is_binding_expired():
                     line = open(cls.LOCAL_SERVER_TXT, "r").read()
                     if line in all_servers:
                         reuse_connection = True
                         LOGGER.debug(f'Re-using server connection at {line}')
 
                 if not reuse_connection:
-                    line = random.choice(all_servers)
-                    open(cls.LOCAL_SERVER_TXT, "w").write(line)
+                    line = cls._select_server(all_servers)
+                    tmp = f'{cls.LOCAL_SERVER_TXT}.{os.getpid()}'
+                    open(tmp, "w").write(line)
+                    os.replace(tmp, cls.LOCAL_SERVER_TXT)
+                    LOGGER.info(f'Bound to server at {line} ({cls.BIND_POLICY})')
         except Exception as e:
             LOGGER.error(f'Failed to bind to local server: {e}')
             return False
@@ -215,29 +482,114 @@ class IO_Redis (IO_Base):
     @classmethod
     def list_servers_to_keys(cls, namespace, keypattern):
         try:
-            redis_keypattern = cls._format_redis_key(namespace, keypattern)
-            redis_prefix = cls._format_redis_key(namespace, '')
+            servers = cls._get_all_servers()
             servers_to_keys = defaultdict(list)
-            conns = cls._get_remote_connections()
-            for conn in conns:
-                hostname = conn.connection_pool.connection_kwargs['host']
-                fnames = conn.keys(redis_keypattern)
-                for fname in fnames:
-                    fname = fname.decode("utf-8")
-                    fname = fname.replace(redis_prefix, "", 1)
-                    servers_to_keys[hostname].append(fname)
-            LOGGER.debug(f'Found {sum([len(d) for d in servers_to_keys.values()])} keys across {len(conns)} servers')
+            servers_to_keys.update(cls._map_servers(
+                lambda s: list(cls.iter_keys_at_server(namespace, keypattern, s)), servers))
+            LOGGER.debug(f'Found {sum([len(d) for d in servers_to_keys.values()])} keys across {len(servers)} servers')
             return servers_to_keys
 
         except Exception as e:
             LOGGER.error(f'Failed to list keys: {e}')
             return {}
 
+    @classmethod
+    def iter_keys(cls, namespace, keypattern='*', count=None):
+        # streams keys server by server with SCAN, which never blocks a server
+        # for long. a key may be repeated if a server rehashes during the scan
+        for server in cls._get_all_servers():
+            yield from cls.iter_keys_at_server(namespace, keypattern, server, count)
+
+    @classmethod
+    def iter_keys_at_server(cls, namespace, keypattern, server, count=None):
+        redis_keypattern = cls._format_redis_key(namespace, keypattern)
+        redis_prefix = cls._format_redis_key(namespace, '')
+        count = cls.SCAN_COUNT if count is None else count
+        try:
+            conn = cls._get_remote_connection(server)
+            for fname in conn.scan_iter(match=redis_keypattern, count=count):
+                yield fname.decode("utf-8").replace(redis_prefix, "", 1)
+        except Exception as e:
+            LOGGER.error(f'Failed to list keys at {server}: {e}')
+
+    @classmethod
+    def watch_keys(cls, namespace, keypattern='*', block=1000, from_start=False):
+        # yields keys as they are saved to the namespace (requires NOTIFY for
+        # the writers). waits up to block milliseconds per round on all servers
+        # at once. from_start also yields the keys still kept in the streams.
+        # the blocking reads use their own threads (one per server) and
+        # connections, so they do not hold up the shared pool
+        stream = cls._format_stream_key(namespace)
+        timeout = cls.SERVER_TIMEOUT + block / 1000
+        conns = {}
+
+        def _get_connection(server):
+            conn = conns.get(server)
+            if conn is None:
+                conn = redis.Redis(host=server, port=int(cls._get_all_servers()[server]),
+                                   socket_timeout=timeout,
+                                   socket_connect_timeout=cls.SERVER_TIMEOUT)
+                conns[server] = conn
+            return conn
+
+        def _last_id(server):
+            if from_start:
+                return '0-0'
+            entries = _get_connection(server).xrevrange(stream, count=1)
+            return entries[0][0] if len(entries) > 0 else '0-0'
+
+        def _read(server):
+            conn = _get_connection(server)
+            return conn.xread({stream: last_ids[server]}, count=cls.BATCH_SIZE, block=block)
+
+        executor, nworkers, initial, last_ids = None, 0, None, {}
+        try:
+            while True:
+                servers = cls._get_all_servers()
+                if len(servers) > nworkers:
+                    if executor is not None:
+                        executor.shutdown(wait=False)
+                    nworkers = len(servers)
+                    executor = ThreadPoolExecutor(max_workers=nworkers,
+                                                  thread_name_prefix=f'{cls.__name__}-watch')
+
+                # the servers present when the watch began are followed from
+                # their last entry, which is looked up again every round until
+                # it succeeds (rather than replaying their streams)
+                if initial is None:
+                    initial = set(servers)
+                missing = [s for s in servers if s in initial and s not in last_ids]
+                if len(missing) > 0:
+                    last_ids.update(cls._map_servers(_last_id, missing, executor, timeout))
+
+                # servers added since the watch began are followed from their start
+                for server in servers:
+                    if server not in initial:
+                        last_ids.setdefault(server, '0-0')
+
+                if len(last_ids) == 0:
+                    time.sleep(block / 1000)
+                    continue
+
+                for server, entries in cls._map_servers(_read, list(last_ids),
+                                                        executor, timeout).items():
+                    for _, messages in entries:
+                        for mid, fields in messages:
+                            last_ids[server] = mid
+                            key = fields[b'key'].decode('utf-8')
+                            if fnmatch.fnmatchcase(key, keypattern):
+                                yield key
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+            for conn in conns.values():
+                conn.close()
+
     @classmethod
     def load_npz_at_server(cls, namespace, keys, hostname, reader_func=read_npz):
         keys_to_data = cls._load_files_at_server(namespace, keys, hostname)
         for key in keys_to_data:
-            keys_to_data[key] = reader_func(io.BytesIO(keys_to_data[key]))
+            keys_to_data[key] = reader_func(io.BytesIO(cls._decode(keys_to_data[key])))
         return keys_to_data
 
     # --------------------------------------------------------------------------
@@ -245,34 +597,134 @@ class IO_Redis (IO_Base):
     # --------------------------------------------------------------------------
     @classmethod
     def _get_local_server(cls):
-        with open(cls.LOCAL_SERVER_TXT) as f:
+        if cls.BIND_INTERVAL is not None and cls._is_binding_expired():
+            cls.bind_local_redis()
+        return cls._read_cached(cls.LOCAL_SERVER_TXT, cls._parse_local_server)
+
+    @classmethod
+    def _is_binding_expired(cls):
+        if cls.BIND_INTERVAL is None:
+            return False
+        try:
+            return time.time() - os.path.getmtime(cls.LOCAL_SERVER_TXT) > cls.BIND_INTERVAL
+        except FileNotFoundError:
+            return True
+
+    @classmethod
+    def _select_server(cls, all_servers):
+        # all_servers are the lines of ALL_SERVERS_TXT ("hostname port")
+        hosts_to_lines = {l.split(' ')[0]: l for l in all_servers if l}
+        if cls.BIND_POLICY == 'random':
+            return random.choice(all_servers)
+
+        if cls.BIND_POLICY == 'least-loaded':
+            def _load(server):
+                info = cls._get_remote_connection(server).info()
+                return info['used_memory'], info['connected_clients']
+
+            # the less loaded of two servers picked at random (power of two
+            # choices), so nodes that bind at the same time spread out instead
+            # of all picking the least loaded server
+            choices = random.sample(list(hosts_to_lines), min(2, len(hosts_to_lines)))
+            loads = cls._map_servers(_load, choices)
+            if len(loads) > 0:
+                # weigh memory and clients equally, relative to the busier server
+                max_memory = max(1, max(m for m, _ in loads.values()))
+                max_clients = max(1, max(c for _, c in loads.values()))
+                server = min(loads, key=lambda s: loads[s][0] / max_memory +
+                                                  loads[s][1] / max_clients)
+                return hosts_to_lines[server]
+
+        elif cls.BIND_POLICY == 'closest':
+            def _rtt(server):
+                conn = cls._get_remote_connection(server)
+                rtts = []
+                for _ in range(3):
+                    t0 = time.perf_counter()
+                    conn.ping()
+                    rtts.append(time.perf_counter() - t0)
+                return min(rtts)
+
+            rtts = cls._map_servers(_rtt, hosts_to_lines)
+            if len(rtts) > 0:
+                return hosts_to_lines[min(rtts, key=rtts.get)]
+
+        else:
+            raise ValueError(f'Invalid bind policy ({cls.BIND_POLICY})')
+
+        LOGGER.warning(f'No server answered for the ({cls.BIND_POLICY}) policy, binding at random')
+        return random.choice(all_servers)
+
+    @classmethod
+    def _get_all_servers(cls):
+        return cls._read_cached(cls.ALL_SERVERS_TXT, cls._parse_all_servers)
+
+    @classmethod
+    def _parse_local_server(cls, filename):
+        with open(filename) as f:
             hostname, port = f.read().strip().split(' ')
         return hostname, port
 
     @classmethod
-    def _get_all_servers(cls):
+    def _parse_all_servers(cls, filename):
         servers_to_ports = {}
-        with open(cls.ALL_SERVERS_TXT) as f:
+        with open(filename) as f:
             for line in f.readlines():
                 hostname, port = line.strip().split(' ')
                 servers_to_ports[hostname] = port
+
+        # drop pools of servers that are no longer listed
+        with IO_Redis._POOLS_LOCK:
+            listed = set(servers_to_ports.items())
+            for key in [k for k in IO_Redis._POOLS if k not in listed]:
+                IO_Redis._POOLS.pop(key).disconnect()
         return servers_to_ports
 
+    @classmethod
+    def _read_cached(cls, filename, parser):
+        # the server files are re-parsed only when they change on disk
+        st = os.stat(filename)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        cached = IO_Redis._FILE_CACHE.get(filename)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, parser(filename))
+            IO_Redis._FILE_CACHE[filename] = cached
+        return cached[1]
+
+    @classmethod
+    def _get_pool(cls, hostname, port):
+        with IO_Redis._POOLS_LOCK:
+            pool = IO_Redis._POOLS.get((hostname, port))
+            if pool is None:
+                pool = redis.ConnectionPool(host=hostname, port=int(port),
+                                            socket_timeout=cls.SERVER_TIMEOUT,
+                                            socket_connect_timeout=cls.SERVER_TIMEOUT)
+                IO_Redis._POOLS[(hostname, port)] = pool
+            return pool
+
+    @classmethod
+    def _reset_state(cls):
+        # a forked child must not share sockets (or a held lock) with its parent.
+        # the old pools are simply dropped: redis-py only shuts down
+        # connections from the process that opened them
+        IO_Redis._POOLS = {}
+        IO_Redis._POOLS_LOCK = threading.Lock()
+        IO_Redis._FILE_CACHE = {}
+
     @classmethod
     def _get_local_connection(cls):
-        hostname, port = cls._get_local_server()
         try:
-            return redis.Redis(host=hostname, port=port)
+            hostname, port = cls._get_local_server()
+            return redis.Redis(connection_pool=cls._get_pool(hostname, port))
         except Exception as e:
             LOGGER.error(f'Failed to connect to local server: {e}')
 
     @classmethod
     def _get_remote_connection(cls, server):
-        servers_to_ports = cls._get_all_servers()
         try:
-            for h, p in servers_to_ports.items():
-                if h == server:
-                    return redis.Redis(host=h, port=p)
+            port = cls._get_all_servers().get(server)
+            if port is not None:
+                return redis.Redis(connection_pool=cls._get_pool(server, port))
             LOGGER.error(f'Failed to open connection. ' +
                          f'Check that server at ({server}) is actually running.')
         except Exception as e:
@@ -282,7 +734,8 @@ class IO_Redis (IO_Base):
     def _get_remote_connections(cls):
         try:
             servers_to_ports = cls._get_all_servers()
-            return [redis.Redis(host=h, port=p) for h, p in servers_to_ports.items()]
+            return [redis.Redis(connection_pool=cls._get_pool(h, p))
+                    for h, p in servers_to_ports.items()]
         except Exception as e:
             LOGGER.error(f'Failed to connect to servers: {e}')
 
@@ -291,14 +744,256 @@ class IO_Redis (IO_Base):
         return f'{namespace}::{key}'
 
     @classmethod
-    def remove_keys_at_server(cls, namespace, keys, server):
+    def _map_servers(cls, func, servers, executor=None, timeout=None):
+        # runs func(server) for all servers concurrently (on the shared pool,
+        # unless an executor is given), and returns {server: result} in the
+        # order of servers. servers that fail, or that do not answer within
+        # timeout seconds of their query starting, are left out. queries still
+        # waiting for a thread are always waited for
+        executor = cls._get_executor() if executor is None else executor
+        timeout = cls.SERVER_TIMEOUT if timeout is None else timeout
+        started = {}
+
+        def _run(server):
+            started[server] = time.monotonic()
+            return func(server)
+
+        futures = {s: executor.submit(_run, s) for s in servers}
+        pending = set(futures.values())
+        while len(pending) > 0:
+            # wake up when the earliest running query is due
+            deadlines = [started[s] + timeout for s, f in futures.items()
+                         if f in pending and s in started]
+            wait_for = timeout if len(deadlines) == 0 else max(0, min(deadlines) - time.monotonic())
+            _, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            now = time.monotonic()
+            for server, future in futures.items():
+                if future in pending and server in started and now - started[server] >= timeout:
+                    pending.discard(future)
+
+        results = {}
+        for server, future in futures.items():
+            if not future.done():
+                LOGGER.error(f'Server ({server}) did not respond in {timeout} seconds')
+                continue
+            try:
+                results[server] = future.result()
+            except Exception as e:
+                LOGGER.error(f'Failed to query server ({server}): {e}')
+        return results
+
+    @classmethod
+    def _save_files_at_conn(cls, conn, namespace, keys, data):
+        for i in range(0, len(keys), cls.BATCH_SIZE):
+            chunk = keys[i:i + cls.BATCH_SIZE]
+            pipe = conn.pipeline(transaction=False)
+            pipe.mset({cls._format_redis_key(namespace, k): cls._encode(d)
+                       for k, d in zip(chunk, data[i:i + cls.BATCH_SIZE])})
+            if cls.NOTIFY:
+                cls._announce_keys(pipe, namespace, chunk)
+            pipe.execute()
+
+    @classmethod
+    def _announce_keys(cls, pipe, namespace, keys):
+        stream = cls._format_stream_key(namespace)
+        for key in keys:
+            pipe.xadd(stream, {'key': key}, maxlen=cls.STREAM_MAXLEN, approximate=True)
+
+    @classmethod
+    def _format_stream_key(cls, namespace):
+        return f'__stream__::{namespace}'
+
+    @classmethod
+    def _get_ring(cls):
+        servers = tuple(sorted(cls._get_all_servers()))
+        ring = IO_Redis._RING
+        if ring is None or ring.servers != servers or ring.vnodes != cls.SHARD_VNODES:
+            ring = HashRing(servers, cls.SHARD_VNODES)
+            IO_Redis._RING = ring
+        return ring
+
+    @classmethod
+    def _get_shard_server(cls, namespace, key):
+        return cls._get_ring().get_server(cls._format_redis_key(namespace, key))
+
+    @classmethod
+    def _group_by_shard(cls, namespace, keys):
+        servers_to_keys = defaultdict(list)
+        for key in keys:
+            servers_to_keys[cls._get_shard_server(namespace, key)].append(key)
+        return servers_to_keys
+
+    @classmethod
+    def _locate_keys(cls, namespace, keys):
+        # returns {server: keys} for the keys whose server is known
+        if cls.SHARDING:
+            return cls._group_by_shard(namespace, keys)
+        if cls.LOCATION_INDEX:
+            return cls._lookup_locations(namespace, keys)
+        return {}
+
+    @classmethod
+    def _probe_on_miss(cls):
+        return not cls.SHARDING or cls.SHARD_FALLBACK
+
+    @classmethod
+    def _format_directory_key(cls, namespace):
+        return f'__location__::{namespace}'
+
+    @classmethod
+    def _get_directory_server(cls):
+        if cls.DIRECTORY_SERVER is not None:
+            return cls.DIRECTORY_SERVER
+        return next(iter(cls._get_all_servers()))
+
+    @classmethod
+    def _get_directory_connection(cls):
+        return cls._get_remote_connection(cls._get_directory_server())
+
+    @classmethod
+    def _lookup_locations(cls, namespace, keys):
+        servers_to_keys = defaultdict(list)
         try:
-            conn = IO_Redis._get_remote_connection(server)
-            for key in keys:
-                redis_key = cls._format_redis_key(namespace, key)
-                if conn.exists(redis_key):
-                    conn.delete(redis_key)
+            conn = cls._get_directory_connection()
+            directory = cls._format_directory_key(namespace)
+            for chunk in cls._chunks(keys):
+                for key, server in zip(chunk, conn.hmget(directory, chunk)):
+                    if server is not None:
+                        servers_to_keys[server.decode('utf-8')].append(key)
         except Exception as e:
-            LOGGER.error(f'Failed to delete files at {server}: {e}')
-    
-# ------------------------------------------------------------------------------
+            LOGGER.error(f'Failed to look up key locations in {namespace}: {e}')
+        return servers_to_keys
+
+    @classmethod
+    def _record_locations(cls, namespace, keys, server):
+        try:
+            conn = cls._get_directory_connection()
+            directory = cls._format_directory_key(namespace)
+            for chunk in cls._chunks(keys):
+                conn.hset(directory, mapping={k: server for k in chunk})
+        except Exception as e:
+            LOGGER.error(f'Failed to record key locations in {namespace}: {e}')
+
+    @classmethod
+    def _forget_locations(cls, namespace, keys):
+        try:
+            conn = cls._get_directory_connection()
+            directory = cls._format_directory_key(namespace)
+            for chunk in cls._chunks(keys):
+                conn.hdel(directory, *chunk)
+        except Exception as e:
+            LOGGER.error(f'Failed to forget key locations in {namespace}: {e}')
+
+    @classmethod
+    def _format_tier_key(cls, namespace):
+        return f'__tier__::{namespace}'
+
+    @classmethod
+    def _load_files_from_tiers(cls, namespace, keys):
+        from .tar import IO_Tar
+
+        keys_to_data = {}
+        try:
+            for archive in cls.get_tiers(namespace):
+                if not IO_Tar.namespace_exists(archive):
+                    continue
+                data = IO_Tar._load_files_partial(archive, keys)
+                keys_to_data.update((k, d) for k, d in zip(keys, data) if d is not None)
+                keys = [k for k in keys if k not in keys_to_data]
+                if len(keys) == 0:
+                    break
+            if len(keys_to_data) > 0:
+                LOGGER.debug(f'Loaded {len(keys_to_data)} keys of {namespace} from tar archives')
+        except Exception as e:
+            LOGGER.error(f'Failed to load files of {namespace} from tar archives: {e}')
+        return keys_to_data
+
+    @classmethod
+    def _get_cache(cls):
+        if cls.CACHE_SIZE <= 0:
+            return None
+        cache = IO_Redis._CACHE
+        if cache is None or cache.path != cls.CACHE_DIR or cache.max_bytes != cls.CACHE_SIZE:
+            cache = LocalCache(cls.CACHE_DIR, cls.CACHE_SIZE)
+            IO_Redis._CACHE = cache
+        return cache
+
+    @classmethod
+    def _uncache(cls, namespace, keys):
+        cache = cls._get_cache()
+        if cache is not None:
+            cache.remove([cls._format_redis_key(namespace, k) for k in keys])
+
+    @classmethod
+    def _rename_at_server(cls, server, old_keys, new_keys):
+        # renames with one script call per chunk, and returns the indices of
+        # the keys that existed (and were renamed). with sharding, keys whose
+        # new name is owned by another server are moved to that server
+        if not cls.SHARDING:
+            return cls._rename_in_place(server, old_keys, new_keys)
+
+        ring = cls._get_ring()
+        owners_to_idxs = defaultdict(list)
+        for i, key in enumerate(new_keys):
+            owners_to_idxs[ring.get_server(key)].append(i)
+
+        renamed = []
+        for owner, idxs in owners_to_idxs.items():
+            func = cls._rename_in_place if owner == server else \
+                functools.partial(cls._move_to_server, owner=owner)
+            moved = func(server, [old_keys[i] for i in idxs], [new_keys[i] for i in idxs])
+            renamed.extend(idxs[j] for j in moved)
+        return sorted(renamed)
+
+    @classmethod
+    def _rename_in_place(cls, server, old_keys, new_keys):
+        conn = cls._get_remote_connection(server)
+        script = conn.register_script(RENAME_SCRIPT)
+        renamed = []
+        for i in range(0, len(old_keys), cls.BATCH_SIZE):
+            chunk = old_keys[i:i + cls.BATCH_SIZE] + new_keys[i:i + cls.BATCH_SIZE]
+            renamed.extend(i + int(j) - 1 for j in script(keys=chunk))
+        return renamed
+
+    @classmethod
+    def _move_to_server(cls, server, old_keys, new_keys, owner):
+        # copies the keys from server to owner (with DUMP and RESTORE), then
+        # unlinks them from server, and returns the indices of the keys that
+        # existed. unlike RENAME, this is not atomic
+        src = cls._get_remote_connection(server)
+        dst = cls._get_remote_connection(owner)
+        moved = []
+        for i in range(0, len(old_keys), cls.BATCH_SIZE):
+            pipe = src.pipeline(transaction=False)
+            for key in old_keys[i:i + cls.BATCH_SIZE]:
+                pipe.dump(key)
+            dumps = [(j, d) for j, d in enumerate(pipe.execute(), i) if d is not None]
+            if len(dumps) == 0:
+                continue
+
+            pipe = dst.pipeline(transaction=False)
+            for j, d in dumps:
+                pipe.restore(new_keys[j], 0, d, replace=True)
+            pipe.execute()
+
+            pipe = src.pipeline(transaction=True)
+            for j, _ in dumps:
+                pipe.unlink(old_keys[j])
+            pipe.execute()
+            moved.extend(j for j, _ in dumps)
+        return moved
+
+    @classmethod
+    def _chunks(cls, keys):
+        for i in range(0, len(keys), cls.BATCH_SIZE):
+            yield keys[i:i + cls.BATCH_SIZE]
+
+    @classmethod
+    def remove_keys_at_server(cls, namespace, keys, server):
+        return cls.remove_files_at_server(namespace, keys, server)
+
+
+os.register_at_fork(after_in_child=IO_Redis._reset_state)
+
+# ------------------------------------------------------------------------------
\ No newline at end of file
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2021, Lawrence Livermore National Security, LLC. All rights
+# reserved. LLNL-CODE-827197. This work was produced at the Lawrence Livermore
+# National Laboratory (LLNL) under contract no. DE-AC52-07NA27344 (Contract 44)
+# between the U.S. Department of Energy (DOE) and Lawrence Livermore National
+# Security, LLC (LLNS) for the operation of LLNL.  See license for disclaimers,
+# notice of U.S. Government Rights and license terms and conditions.
+# -----------------------------------------------------------------------------
+
+import os
+import io
+import asyncio
+import weakref
+import redis.asyncio
+from logging import getLogger
+from collections import defaultdict
+
+from .base import check_extn
+from .redis import IO_Redis
+from .default_functions import write_npz, read_npz, read_npz_lazy
+
+LOGGER = getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+# Asynchronous Redis Interface
+# uses the same servers, configuration, and key layout as IO_Redis, but the
+# data functions are coroutines that can be overlapped in one event loop:
+#   data = await IO_RedisAsync.load_files(namespace, keys)
+# ------------------------------------------------------------------------------
+class IO_RedisAsync (IO_Redis):
+
+    # asyncio pools cannot be shared across event loops
+    _ASYNC_POOLS = weakref.WeakKeyDictionary()
+
+    # --------------------------------------------------------------------------
+    # Public Abstract functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    def get_type(cls):
+        return 'redis-async'
+
+    @classmethod
+    async def file_exists(cls, namespace, key):
+        assert isinstance(namespace, str) and isinstance(key, str)
+        redis_key = cls._format_redis_key(namespace, key)
+        try:
+            for server in await cls._locate_keys_async(namespace, [key]):
+                if await cls._get_async_connection(server).exists(redis_key):
+                    return True
+            if not cls._probe_on_miss():
+                return False
+
+            exists = await cls._map_servers_async(
+                lambda s: cls._get_async_connection(s).exists(redis_key),
+                cls._get_all_servers())
+            return any(exists.values())
+        except Exception as e:
+            LOGGER.error(f'Failed to check file exists: {e}')
+        return False
+
+    @classmethod
+    async def files_exist(cls, namespace, keys):
+        assert isinstance(namespace, str) and isinstance(keys, list)
+        exists = dict.fromkeys(keys, False)
+        try:
+            servers_to_keys = await cls._locate_keys_async(namespace, keys)
+            if len(servers_to_keys) > 0:
+                servers_to_found = await cls._map_servers_async(
+                    lambda s: cls._files_exist_at_server_async(namespace, servers_to_keys[s], s),
+                    servers_to_keys)
+                for found in servers_to_found.values():
+                    exists.update(dict.fromkeys(found, True))
+
+            remaining_keys = [k for k in keys if not exists[k]]
+            if len(remaining_keys) > 0 and cls._probe_on_miss():
+                servers_to_found = await cls._map_servers_async(
+                    lambda s: cls._files_exist_at_server_async(namespace, remaining_keys, s),
+                    cls._get_all_servers())
+                for found in servers_to_found.values():
+                    exists.update(dict.fromkeys(found, True))
+        except Exception as e:
+            LOGGER.error(f'Failed to check files exist: {e}')
+        return [exists[k] for k in keys]
+
+    # --------------------------------------------------------------------------
+    # Public interface
+    # --------------------------------------------------------------------------
+    @classmethod
+    async def list_keys(cls, namespace, keypattern, max_keys=None):
+
+        # scan all servers at once, each stopping after max_keys keys
+        async def _list(server):
+            keys = []
+            async for key in cls.iter_keys_at_server_async(namespace, keypattern, server):
+                keys.append(os.path.basename(key))
+                if max_keys is not None and len(keys) >= max_keys:
+                    break
+            return keys
+
+        servers_to_keys = await asyncio.gather(*[_list(s) for s in cls._get_all_servers()])
+        keys = list(set(k for keys in servers_to_keys for k in keys))
+        return keys if max_keys is None else keys[:max_keys]
+
+    @classmethod
+    async def load_files(cls, namespace, filenames):
+
+        if isinstance(filenames, list):
+            data = await cls._load_files_async(namespace, filenames)
+            return [cls._decode(d) for d in data]
+
+        if isinstance(filenames, str):
+            return cls._decode((await cls._load_files_async(namespace, [filenames]))[0])
+
+        raise ValueError(f'Incorrect arguments (keys={type(filenames)}). '
+                         f'Need a filename or a list of filenames')
+
+    @classmethod
+    async def save_files(cls, namespace, keys, data):
+
+        assert isinstance(keys, list) == isinstance(data, list)
+
+        if isinstance(keys, list) and isinstance(data, list):
+            assert len(keys) == len(data)
+            return await cls._save_files_async(namespace, keys, data)
+
+        if isinstance(keys, str):
+            return await cls._save_files_async(namespace, [keys], [data])
+
+        raise ValueError(f'Incorrect arguments (keys={type(keys)}). '
+                         f'Need a filename or a list of filenames')
+
+    @classmethod
+    async def remove_files(cls, namespace, keys):
+
+        if isinstance(keys, list):
+            return await cls._remove_files_async(namespace, keys)
+
+        if isinstance(keys, str):
+            return (await cls._remove_files_async(namespace, [keys]))[0]
+
+        raise ValueError(f'Incorrect arguments (keys={type(keys)}). '
+                         f'Need a filename or a list of filenames')
+
+    @classmethod
+    async def load_npz(cls, namespace, keys, reader_func=read_npz, lazy=False):
+
+        if isinstance(keys, list):
+            keys = [check_extn(k, '.npz') for k in keys]
+            data = await cls._load_files_async(namespace, keys)
+            if lazy:
+                return [read_npz_lazy(cls._decode(d)) for d in data]
+            return [reader_func(io.BytesIO(cls._decode(d))) for d in data]
+
+        elif isinstance(keys, str):
+            keys = check_extn(keys, '.npz')
+            data = (await cls._load_files_async(namespace, [keys]))[0]
+            if lazy:
+                return read_npz_lazy(cls._decode(data))
+            return reader_func(io.BytesIO(cls._decode(data)))
+
+        raise ValueError(f'Incorrect arguments (keys={type(keys)}). '
+                         f'Need a filename or a list of filenames')
+
+    @classmethod
+    async def save_npz(cls, namespace, keys, data, writer_func=write_npz):
+
+        if isinstance(keys, list):
+            keys = [check_extn(k, '.npz') for k in keys]
+            dbytes = [writer_func(io.BytesIO(), d).getvalue() for d in data]
+            return await cls._save_files_async(namespace, keys, dbytes)
+
+        if isinstance(keys, str):
+            keys = check_extn(keys, '.npz')
+            dbytes = writer_func(io.BytesIO(), data).getvalue()
+            return await cls._save_files_async(namespace, [keys], [dbytes])
+
+        raise ValueError(f'Incorrect arguments (keys={type(keys)}). '
+                         f'Need a filename or a list of filenames')
+
+    # --------------------------------------------------------------------------
+    # IO_RedisAsync Public Functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    async def iter_keys_at_server_async(cls, namespace, keypattern, server, count=None):
+        redis_keypattern = cls._format_redis_key(namespace, keypattern)
+        redis_prefix = cls._format_redis_key(namespace, '')
+        count = cls.SCAN_COUNT if count is None else count
+        try:
+            conn = cls._get_async_connection(server)
+            async for fname in conn.scan_iter(match=redis_keypattern, count=count):
+                yield fname.decode("utf-8").replace(redis_prefix, "", 1)
+        except Exception as e:
+            LOGGER.error(f'Failed to list keys at {server}: {e}')
+
+    # --------------------------------------------------------------------------
+    # IO_RedisAsync Private Functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    async def _load_files_async(cls, namespace, keys):
+
+        data = [None] * len(keys)
+        idxs = {k: v for v, k in enumerate(keys)}
+        remaining_keys = keys
+        servers = cls._get_all_servers()
+
+        # the node cache is on disk, so it is read and written off the event loop
+        cache = cls._get_cache()
+        if cache is not None:
+            redis_keys = [cls._format_redis_key(namespace, k) for k in keys]
+            keys_to_data = await asyncio.to_thread(cache.get, redis_keys)
+            for k in keys:
+                d = keys_to_data.get(cls._format_redis_key(namespace, k))
+                if d is not None:
+                    data[idxs[k]] = d
+            remaining_keys = [k for k in keys if data[idxs[k]] is None]
+            markers = await asyncio.to_thread(
+                cache.markers, [cls._format_redis_key(namespace, k) for k in remaining_keys])
+        uncached_keys = remaining_keys
+
+        servers_to_keys = await cls._locate_keys_async(namespace, remaining_keys)
+        if len(servers_to_keys) > 0:
+            servers_to_data = await cls._map_servers_async(
+                lambda s: cls._load_files_at_server_async(namespace, servers_to_keys[s], s),
+                servers_to_keys)
+            for keys_to_data in servers_to_data.values():
+                for k in keys_to_data:
+                    data[idxs[k]] = keys_to_data[k]
+            remaining_keys = [k for k in remaining_keys if data[idxs[k]] is None]
+        if not cls._probe_on_miss():
+            servers = []
+
+        if len(remaining_keys) > 0 and len(servers) > 0:
+            servers_to_data = await cls._map_servers_async(
+                lambda s: cls._load_files_at_server_async(namespace, remaining_keys, s), servers)
+            for keys_to_data in servers_to_data.values():
+                for k in keys_to_data:
+                    if data[idxs[k]] is None:
+                        data[idxs[k]] = keys_to_data[k]
+            remaining_keys = [k for k in remaining_keys if data[idxs[k]] is None]
+
+        # the archives are read (and listed) synchronously, off the event loop
+        if len(remaining_keys) > 0 and cls.TIER_FALLBACK:
+            keys_to_data = await asyncio.to_thread(cls._load_files_from_tiers,
+                                                   namespace, remaining_keys)
+            for k in keys_to_data:
+                data[idxs[k]] = keys_to_data[k]
+            remaining_keys = [k for k in remaining_keys if data[idxs[k]] is None]
+
+        if cache is not None:
+            await asyncio.to_thread(cache.put, {cls._format_redis_key(namespace, k): data[idxs[k]]
+                                                for k in uncached_keys if data[idxs[k]] is not None},
+                                    markers)
+        LOGGER.debug(f'Loaded {len(keys)-len(remaining_keys)} out of {len(keys)} ' +
+                     f'keys across {len(servers)} servers')
+        return data
+
+    @classmethod
+    async def _load_files_at_server_async(cls, namespace, keys, server):
+        keys_to_data = {}
+        try:
+            conn = cls._get_async_connection(server)
+            for chunk in cls._chunks(keys):
+                redis_keys = [cls._format_redis_key(namespace, k) for k in chunk]
+                for key, d in zip(chunk, await conn.mget(redis_keys)):
+                    if d is not None:
+                        keys_to_data[key] = d
+        except Exception as e:
+            LOGGER.error(f'Failed to load files at {server}: {e}')
+        return keys_to_data
+
+    @classmethod
+    async def _files_exist_at_server_async(cls, namespace, keys, server):
+        found = []
+        conn = cls._get_async_connection(server)
+        for chunk in cls._chunks(keys):
+            pipe = conn.pipeline(transaction=False)
+            for key in chunk:
+                pipe.exists(cls._format_redis_key(namespace, key))
+            found.extend(k for k, n in zip(chunk, await pipe.execute()) if n)
+        return found
+
+    @classmethod
+    async def _save_files_async(cls, namespace, keys, data):
+
+        LOGGER.debug(f'Writing {len(keys)} files to ({namespace})')
+        try:
+            if cls.SHARDING:
+                servers_to_keys = cls._group_by_shard(namespace, keys)
+            else:
+                # binding (when due) takes a file lock and queries the servers
+                server = (await asyncio.to_thread(cls._get_local_server))[0]
+                servers_to_keys = {server: keys}
+
+            keys_to_data = dict(zip(keys, data))
+            await asyncio.gather(*[
+                cls._save_files_at_server_async(namespace, skeys,
+                                                [keys_to_data[k] for k in skeys], server)
+                for server, skeys in servers_to_keys.items()])
+            await asyncio.to_thread(cls._uncache, namespace, keys)
+            LOGGER.info(f'Wrote {len(keys)} files across {len(servers_to_keys)} servers')
+            return True
+        except Exception as e:
+            LOGGER.error(f'Failed to save files: {e}')
+            return False
+
+    @classmethod
+    async def _save_files_at_server_async(cls, namespace, keys, data, server):
+        conn = cls._get_async_connection(server)
+        for i in range(0, len(keys), cls.BATCH_SIZE):
+            chunk = keys[i:i + cls.BATCH_SIZE]
+            pipe = conn.pipeline(transaction=False)
+            pipe.mset({cls._format_redis_key(namespace, k): cls._encode(d)
+                       for k, d in zip(chunk, data[i:i + cls.BATCH_SIZE])})
+            if cls.NOTIFY:
+                cls._announce_keys(pipe, namespace, chunk)
+            await pipe.execute()
+        if cls.LOCATION_INDEX and not cls.SHARDING:
+            await cls._record_locations_async(namespace, keys, server)
+
+    @classmethod
+    async def _remove_files_async(cls, namespace, keys):
+
+        remaining_keys = keys
+        servers = cls._get_all_servers()
+
+        servers_to_keys = await cls._locate_keys_async(namespace, keys)
+        if len(servers_to_keys) > 0:
+            servers_to_removed = await cls._map_servers_async(
+                lambda s: cls._remove_files_at_server_async(namespace, servers_to_keys[s], s),
+                servers_to_keys)
+            removed = set(k for d in servers_to_removed.values() for k in d)
+            remaining_keys = [k for k in keys if not k in removed]
+        if not cls._probe_on_miss():
+            servers = []
+
+        if len(remaining_keys) > 0 and len(servers) > 0:
+            servers_to_removed = await cls._map_servers_async(
+                lambda s: cls._remove_files_at_server_async(namespace, remaining_keys, s), servers)
+            removed = set(k for d in servers_to_removed.values() for k in d)
+            remaining_keys = [k for k in remaining_keys if not k in removed]
+
+        LOGGER.debug(f'Removed {len(keys) - len(remaining_keys)} out of {len(keys)} keys ' +
+                     f'across {len(servers)} servers')
+        remaining_keys = set(remaining_keys)
+        return [k not in remaining_keys for k in keys]
+
+    @classmethod
+    async def _remove_files_at_server_async(cls, namespace, keys, server):
+        removed = []
+        try:
+            conn = cls._get_async_connection(server)
+            for chunk in cls._chunks(keys):
+                pipe = conn.pipeline(transaction=True)
+                for key in chunk:
+                    pipe.unlink(cls._format_redis_key(namespace, key))
+                removed.extend(k for k, n in zip(chunk, await pipe.execute()) if n)
+            await asyncio.to_thread(cls._uncache, namespace, removed)
+            if cls.LOCATION_INDEX:
+                await cls._forget_locations_async(namespace, removed)
+            LOGGER.debug(f'Deleted {len(removed)} out of {len(keys)} keys at {server}')
+        except Exception as e:
+            LOGGER.error(f'Failed to delete keys in {namespace} at {server}: {e}')
+        return removed
+
+    @classmethod
+    async def _map_servers_async(cls, func, servers):
+        # awaits func(server) for all servers concurrently, and returns
+        # {server: result} in the order of servers. servers that fail or
+        # time out are left out
+        servers = list(servers)
+        results = await asyncio.gather(
+            *[asyncio.wait_for(func(s), cls.SERVER_TIMEOUT) for s in servers],
+            return_exceptions=True)
+        servers_to_results = {}
+        for server, result in zip(servers, results):
+            if isinstance(result, asyncio.TimeoutError):
+                LOGGER.error(f'Server ({server}) did not respond in {cls.SERVER_TIMEOUT} seconds')
+            elif isinstance(result, Exception):
+                LOGGER.error(f'Failed to query server ({server}): {result}')
+            else:
+                servers_to_results[server] = result
+        return servers_to_results
+
+    @classmethod
+    async def _locate_keys_async(cls, namespace, keys):
+        if cls.SHARDING:
+            return cls._group_by_shard(namespace, keys)
+        if cls.LOCATION_INDEX:
+            return await cls._lookup_locations_async(namespace, keys)
+        return {}
+
+    @classmethod
+    async def _lookup_locations_async(cls, namespace, keys):
+        servers_to_keys = defaultdict(list)
+        try:
+            conn = cls._get_async_connection(cls._get_directory_server())
+            directory = cls._format_directory_key(namespace)
+            for chunk in cls._chunks(keys):
+                for key, server in zip(chunk, await conn.hmget(directory, chunk)):
+                    if server is not None:
+                        servers_to_keys[server.decode('utf-8')].append(key)
+        except Exception as e:
+            LOGGER.error(f'Failed to look up key locations in {namespace}: {e}')
+        return servers_to_keys
+
+    @classmethod
+    async def _record_locations_async(cls, namespace, keys, server):
+        try:
+            conn = cls._get_async_connection(cls._get_directory_server())
+            directory = cls._format_directory_key(namespace)
+            for chunk in cls._chunks(keys):
+                await conn.hset(directory, mapping={k: server for k in chunk})
+        except Exception as e:
+            LOGGER.error(f'Failed to record key locations in {namespace}: {e}')
+
+    @classmethod
+    async def _forget_locations_async(cls, namespace, keys):
+        try:
+            conn = cls._get_async_connection(cls._get_directory_server())
+            directory = cls._format_directory_key(namespace)
+            for chunk in cls._chunks(keys):
+                await conn.hdel(directory, *chunk)
+        except Exception as e:
+            LOGGER.error(f'Failed to forget key locations in {namespace}: {e}')
+
+    @classmethod
+    def _get_async_connection(cls, server):
+        port = cls._get_all_servers().get(server)
+        if port is None:
+            raise Exception(f'Server ({server}) is not listed in ({cls.ALL_SERVERS_TXT})')
+
+        pools = IO_RedisAsync._ASYNC_POOLS.setdefault(asyncio.get_running_loop(), {})
+        pool = pools.get((server, port))
+        if pool is None:
+            pool = redis.asyncio.ConnectionPool(host=server, port=int(port),
+                                                socket_timeout=cls.SERVER_TIMEOUT,
+                                                socket_connect_timeout=cls.SERVER_TIMEOUT)
+            pools[(server, port)] = pool
+        return redis.asyncio.Redis(connection_pool=pool)
+
+    @classmethod
+    def _reset_async_state(cls):
+        IO_RedisAsync._ASYNC_POOLS = weakref.WeakKeyDictionary()
+
+
+os.register_at_fork(after_in_child=IO_RedisAsync._reset_async_state)
+
+# ------------------------------------------------------------------------------
@@ -10,11 +10,15 @@
 # -----------------------------------------------------------------------------
 
 import glob
+import hashlib
+import itertools
 import os
 import os.path
 import shutil
+import threading
+from concurrent.futures import wait
 from logging import getLogger
-from .base import IO_Base
+from .base import IO_Base, scan_files
 
 LOGGER = getLogger(__name__)
 
@@ -24,6 +28,19 @@ LOGGER = getLogger(__name__)
 # ------------------------------------------------------------------------------
 class IO_Simple (IO_Base):
 
+    # with SHARDED, keys are stored in two levels of subdirectories named by
+    # the hash of the key (e.g., namespace/3f/a2/key), so no directory holds
+    # too many files. flat namespaces can be converted with migrate_namespace
+    SHARDED = False
+
+    # files are written to a hidden temporary file next to them, and renamed
+    # into place, so readers never see partial files. FSYNC makes them durable:
+    #   'none'   leaves it to the file system
+    #   'file'   syncs each file before it is renamed, and its directory after
+    #   'batch'  syncs each file before it is renamed, and each directory
+    #            written to once per save_files
+    FSYNC = 'none'
+
     # --------------------------------------------------------------------------
     # Public Abstract functions
     # --------------------------------------------------------------------------
@@ -38,7 +55,18 @@ class IO_Simple (IO_Base):
     @classmethod
     def file_exists(cls, namespace, key):
         assert isinstance(namespace, str) and isinstance(key, str)
-        return os.path.isfile(os.path.join(namespace, key))
+        return os.path.isfile(cls._get_path(namespace, key))
+
+    @classmethod
+    def files_exist(cls, namespace, keys):
+        assert isinstance(namespace, str) and isinstance(keys, list)
+        if len(keys) <= 1:
+            return [cls.file_exists(namespace, k) for k in keys]
+
+        # read each directory once, instead of a stat per key
+        paths = [os.path.split(cls._get_path(namespace, k)) for k in keys]
+        files = {d: scan_files(d, hidden=True) for d in set(d for d, _ in paths)}
+        return [f in files[d] for d, f in paths]
 
     @classmethod
     def namespace_exists(cls, namespace):
@@ -49,33 +77,41 @@ class IO_Simple (IO_Base):
     # Private Abstract functions
     # --------------------------------------------------------------------------
     @classmethod
-    def _list_keys(cls, namespace, keypattern):
-        return glob.glob(os.path.join(namespace, keypattern))
+    def _list_keys(cls, namespace, keypattern, max_keys=None):
+        if cls.SHARDED:
+            keypattern = os.path.join('??', '??', keypattern)
+        keys = glob.iglob(os.path.join(namespace, keypattern))
+        return list(itertools.islice(keys, max_keys))
 
     @classmethod
     def _move_key(cls, namespace, old, new):
         LOGGER.debug(f'moving ({old}) to ({new}) in namespace ({namespace})')
-        shutil.move(os.path.join(namespace, old), os.path.join(namespace, new))
+        new = cls._get_path(namespace, new)
+        if cls.SHARDED:
+            os.makedirs(os.path.dirname(new), exist_ok=True)
+        shutil.move(cls._get_path(namespace, old), new)
 
     @classmethod
     def _load_files(cls, namespace, filenames):
 
-        # TODO: think about how to load ASCII data
-        def _read(f):
-            with open(f, 'rb') as fp:
-                d = fp.read()
-            return d
+        data = cls._load_files_partial(namespace, filenames)
+        if any(d is None for d in data):
+            return None
+        return data
 
-        filenames = [os.path.join(namespace, _) for _ in filenames]
+    @classmethod
+    def _load_files_partial(cls, namespace, filenames):
 
-        # check if all files are found
-        for filename in filenames:
-            if not os.path.isfile(filename):
-                LOGGER.debug(f'File ({filename}) does not exist!')
+        # TODO: think about how to load ASCII data
+        def _read(f):
+            try:
+                with open(f, 'rb') as fp:
+                    return fp.read()
+            except (FileNotFoundError, IsADirectoryError):
+                LOGGER.debug(f'File ({f}) does not exist!')
                 return None
 
-        data = [_read(_) for _ in filenames]
-        return data
+        return cls._map_files(_read, [cls._get_path(namespace, _) for _ in filenames])
 
     @classmethod
     def _save_files(cls, namespace, filenames, data):
@@ -83,11 +119,18 @@ class IO_Simple (IO_Base):
         LOGGER.debug(f'Writing {len(filenames)} files to ({namespace})')
         try:
             os.makedirs(namespace, exist_ok=True)
-            filenames = [os.path.join(namespace, _) for _ in filenames]
-            for i,fname in enumerate(filenames):
-                mode = cls._wmode(data[i])
-                with open(fname, mode) as fp:
-                    fp.write(data[i])
+            filenames = [cls._get_path(namespace, _) for _ in filenames]
+
+            def _write(i):
+                fname = filenames[i]
+                if cls.SHARDED:
+                    os.makedirs(os.path.dirname(fname), exist_ok=True)
+                d = data[i] if cls.CODEC is None else cls._encode(data[i])
+                cls._write_file(fname, d)
+
+            cls._map_files(_write, range(len(filenames)))
+            if cls.FSYNC == 'batch':
+                cls._map_files(cls._fsync_dir, sorted(set(os.path.dirname(_) for _ in filenames)))
             LOGGER.info(f'Wrote {len(filenames)} files to ({namespace})')
             return True
         except Exception as e:
@@ -97,10 +140,110 @@ class IO_Simple (IO_Base):
     @classmethod
     def _remove_files(cls, namespace, filenames):
 
-        filenames = [os.path.join(namespace, _) for _ in filenames]
+        filenames = [cls._get_path(namespace, _) for _ in filenames]
         for filename in filenames:
             if not os.path.isfile(filename):
                 LOGGER.debug(f'File ({filename}) does not exist!')
             os.remove(filename)
 
+    # --------------------------------------------------------------------------
+    # IO_Simple Specific Functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    def scan_keys(cls, namespace, keypattern='*'):
+        # returns the set of keys that match keypattern, reading each directory
+        # of the namespace once
+        if not cls.SHARDED:
+            return scan_files(namespace, keypattern)
+
+        keys = set()
+        for d in glob.iglob(os.path.join(namespace, '??', '??')):
+            keys.update(scan_files(d, keypattern))
+        return keys
+
+    @classmethod
+    def migrate_namespace(cls, namespace):
+        # moves the keys of a flat namespace into their sharded subdirectories,
+        # and returns the number of keys moved. an interrupted migration can be
+        # resumed by calling this again. hidden files (e.g., temporary files
+        # of writes) are left alone, and so are keys already written to their
+        # sharded path, which are newer
+        n = 0
+        with os.scandir(namespace) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                path = cls._get_sharded_path(namespace, entry.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    # unlike a rename, a link does not replace the target
+                    os.link(entry.path, path)
+                except FileExistsError:
+                    if not os.path.samefile(entry.path, path):
+                        LOGGER.warning(f'Not moving ({entry.path}): ({path}) already exists')
+                        continue
+                os.remove(entry.path)
+                n += 1
+
+        LOGGER.info(f'Moved {n} keys of ({namespace}) into sharded subdirectories')
+        return n
+
+    # --------------------------------------------------------------------------
+    # IO_Simple Private Functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    def _map_files(cls, func, items):
+        # returns [func(item) for item in items], run on the shared thread pool
+        # (of MAX_WORKERS threads) for more than one item, since file I/O
+        # releases the GIL. the first exception is raised once all are done
+        items = list(items)
+        if len(items) <= 1 or cls.MAX_WORKERS <= 1:
+            return [func(_) for _ in items]
+
+        futures = [cls._get_executor().submit(func, _) for _ in items]
+        wait(futures)
+        return [f.result() for f in futures]
+
+    @classmethod
+    def _write_file(cls, fname, d):
+        if cls.FSYNC not in ['none', 'file', 'batch']:
+            raise ValueError(f'Invalid fsync policy ({cls.FSYNC})')
+
+        dirname, basename = os.path.split(fname)
+        tmp = os.path.join(dirname, f'.{basename}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            # the data must be durable before the rename is, or a crash can
+            # leave an empty or torn file under the final name
+            with open(tmp, cls._wmode(d)) as fp:
+                fp.write(d)
+                if cls.FSYNC != 'none':
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            os.replace(tmp, fname)
+            if cls.FSYNC == 'file':
+                cls._fsync_dir(dirname)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @classmethod
+    def _fsync_dir(cls, dirname):
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _get_path(cls, namespace, key):
+        if cls.SHARDED:
+            return cls._get_sharded_path(namespace, key)
+        return os.path.join(namespace, key)
+
+    @classmethod
+    def _get_sharded_path(cls, namespace, key):
+        h = hashlib.md5(key.encode('utf-8'), usedforsecurity=False).hexdigest()
+        return os.path.join(namespace, h[:2], h[2:4], key)
+
 # ------------------------------------------------------------------------------
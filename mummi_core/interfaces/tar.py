@@ -9,15 +9,24 @@
 # notice of U.S. Government Rights and license terms and conditions.
 # -----------------------------------------------------------------------------
 
+import atexit
+import fcntl
+import fnmatch
 import functools
 import io
+import mmap
 import os
 import os.path
+import re
 import tarfile
+import tempfile
+import threading
 import time
 import numpy as np
 from logging import getLogger
-from pathlib import Path
+from contextlib import contextmanager
+from collections import OrderedDict
+from filelock import FileLock
 from pytaridx import IndexedTarFile
 
 from .base import IO_Base, check_extn
@@ -30,6 +39,23 @@ LOGGER = getLogger(__name__)
 # ------------------------------------------------------------------------------
 class IO_Tar (IO_Base):
 
+    # keep up to MAX_HANDLES archives open (least recently used are closed).
+    # a handle is reopened if its archive has changed since it was last used
+    MAX_HANDLES = 16
+
+    # members are read from a memory map of the archive in the order they are
+    # stored, and members less than READ_GAP bytes apart are prefetched
+    # together. with ZERO_COPY, loaded data are memoryviews of the map
+    READ_GAP = 1 << 20
+    ZERO_COPY = False
+
+    # files that compact writes next to the archive, and renames into place
+    _COMPACT_EXTNS = ['.pylst', '.pytree', '.pyidx', '.pyidx.pos', '']
+
+    # process-wide pool of open archives {(namespace, mode): (handle, stat)}
+    _HANDLES = OrderedDict()
+    _HANDLES_LOCK = threading.Lock()
+
     # --------------------------------------------------------------------------
     # Public Abstract functions
     # --------------------------------------------------------------------------
@@ -49,11 +75,9 @@ class IO_Tar (IO_Base):
         if not os.path.isfile(namespace) or not os.path.isfile(namespace + '.pylst'):
             return False
 
-        tf = IndexedTarFile()
-        tf.open(namespace, 'r')
-        exists = tf.exist(key)
-        tf.close()
-        return exists
+        # the .pytree can miss members, and does not always return the latest
+        # entry of a key (e.g., a tombstone), so use the binary index
+        return cls.files_exist(namespace, [key])[0]
 
     @classmethod
     def files_exist(cls, namespace, keys):
@@ -65,11 +89,8 @@ class IO_Tar (IO_Base):
         if not os.path.isfile(namespace) or not os.path.isfile(namespace + '.pylst'):
             return [False for i in range(n)]
 
-        tf = IndexedTarFile()
-        tf.open(namespace, 'r')
-        exists = [tf.exist(key) for key in keys]
-        tf.close()
-        return exists
+        # deleted keys have tombstones (entries of size -1)
+        return [bool(s >= 0) for s in cls.lookup_index(namespace, keys)[1]]
 
     @classmethod
     def namespace_exists(cls, namespace):
@@ -78,39 +99,77 @@ class IO_Tar (IO_Base):
         namespace = check_extn(namespace, '.tar')
         return os.path.isfile(namespace) and os.path.isfile(namespace+'.pylst')
 
+    # --------------------------------------------------------------------------
+    # Public interface
+    # --------------------------------------------------------------------------
+    @classmethod
+    def list_keys(cls, namespace, keypattern, max_keys=None, offset=0):
+        # keys come sorted (and unique) from the index, so they can be paged
+        # through with offset and max_keys. as in IO_Base.list_keys, members in
+        # subdirectories are listed by their basename, once per page (offset
+        # and max_keys count the full names)
+        keys = cls._list_keys(namespace, keypattern, max_keys, offset)
+        return list(dict.fromkeys(os.path.basename(k) for k in keys))
+
     # --------------------------------------------------------------------------
     # Private Abstract functions
     # --------------------------------------------------------------------------
     @classmethod
-    def _list_keys(cls, namespace, keypattern):
+    def _list_keys(cls, namespace, keypattern, max_keys=None, offset=0):
 
-        all_keys = cls.load_index(namespace)[:,0]
-        return [p for p in all_keys if Path(p).match(keypattern)]
+        index = cls._match_index(cls.load_binary_index(namespace), keypattern)
+        end = None if max_keys is None else offset + max_keys
+        names = index['name'][index['size'] >= 0][offset:end]
+        return [n.decode('utf-8') for n in names.tolist()]
 
     @classmethod
     def _move_key(cls, namespace, old, new):
-        raise Exception('IO_Tar cannot move keys')
+        LOGGER.debug(f'moving ({old}) to ({new}) in namespace ({namespace})')
+        data = cls._load_files(namespace, [old])
+        if data is None:
+            raise Exception(f'Key ({old}) does not exist in ({namespace})')
+        if not cls._save_files(namespace, [new], [bytes(cls._decode(data[0]))]):
+            raise Exception(f'Failed to move ({old}) to ({new}) in ({namespace})')
+        cls._remove_files(namespace, [old])
 
     @classmethod
     def _load_files(cls, namespace, filenames):
 
-        namespace = check_extn(namespace, '.tar')
+        data = cls._load_files_partial(namespace, filenames)
+        if any(d is None for d in data):
+            return None
+        return data
 
-        # open the tar file
-        tf = IndexedTarFile()
-        tf.open(namespace, 'r')
+    @classmethod
+    def _load_files_partial(cls, namespace, filenames):
 
-        # check if all files are found
-        for filename in filenames:
-            if not tf.exist(filename):
-                tf.close()
-                LOGGER.debug(f'File ({filename}) does not exist!')
-                return None
+        namespace = check_extn(namespace, '.tar')
+        # (IO_TarSharded reads its shards through here)
+        if not IO_Tar.namespace_exists(namespace):
+            LOGGER.debug(f'Archive ({namespace}) does not exist!')
+            return [None] * len(filenames)
+
+        # locate the files in the binary index, which (unlike the .pytree)
+        # has every member listed in the .pylst. the index and the archive
+        # must not be swapped by compact in between
+        with cls._swap_lock(namespace, exclusive=False):
+            offsets, sizes = cls.lookup_index(namespace, filenames)
+            found = [i for i, size in enumerate(sizes) if size >= 0]
+            for i in range(len(filenames)):
+                if sizes[i] < 0:
+                    LOGGER.debug(f'File ({filenames[i]}) does not exist!')
+
+            data = [None] * len(filenames)
+            if len(found) == 0:
+                return data
+            with open(namespace, 'rb') as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
 
         # now, read all files
-        files = [tf.read(_) for _ in filenames]
-        tf.close()
-        return files
+        locations = [(int(offsets[i]), int(sizes[i])) for i in found]
+        for i, d in zip(found, cls._read_mapped(mm, locations)):
+            data[i] = d
+        return data
 
     @classmethod
     def _save_files(cls, namespace, filenames, data):
@@ -119,14 +178,9 @@ class IO_Tar (IO_Base):
             namespace = check_extn(namespace, '.tar')
             os.makedirs(os.path.dirname(namespace), exist_ok=True)
 
-            tf = IndexedTarFile()
-            tf.open(namespace, 'r+')
-            for i, fname in enumerate(filenames):
-                d = cls._encode(data[i])
-                with io.BytesIO() as stream:
-                    stream.write(d)
-                    tf.write(fname, stream.getvalue())
-            tf.close()
+            cls._recover_compact(namespace)
+            with cls._write_lock(namespace):
+                cls._write_members(namespace, filenames, data)
             LOGGER.debug(f'Wrote {len(filenames)} files to ({namespace})')
             return True
         except Exception as e:
@@ -135,7 +189,20 @@ class IO_Tar (IO_Base):
 
     @classmethod
     def _remove_files(cls, namespace, filenames):
-        raise Exception('IO_Tar cannot delete keys')
+
+        # keys are deleted by tombstones (entries of size -1) in the index,
+        # and their data stay in the archive until it is compacted
+        namespace = check_extn(namespace, '.tar')
+        # (IO_TarSharded reads its shards through here)
+        if not IO_Tar.namespace_exists(namespace):
+            return [False] * len(filenames)
+
+        removed = cls.files_exist(namespace, filenames)
+        cls._recover_compact(namespace)
+        with cls._write_lock(namespace):
+            cls._write_tombstones(namespace, [f for f, r in zip(filenames, removed) if r])
+        LOGGER.debug(f'Deleted {sum(removed)} out of {len(filenames)} keys in ({namespace})')
+        return removed
 
     # --------------------------------------------------------------------------
     # IO_Tar Specific Functions
@@ -147,8 +214,14 @@ class IO_Tar (IO_Base):
             return
 
         LOGGER.info(f'Regenerating index for ({filename})')
+        cls.close_handles(filename)
         os.remove(f'{filename}.pylst')
         os.remove(f'{filename}.pytree')
+        for f in [f'{filename}.pyidx', f'{filename}.pyidx.pos']:
+            if os.path.exists(f):
+                os.remove(f)
+
+        # NOTE: tombstones are only in the index, so deleted keys come back
 
         tf = IndexedTarFile()
         tf.open(filename, 'r+')
@@ -165,6 +238,16 @@ class IO_Tar (IO_Base):
         if not os.path.exists(pylst):
             LOGGER.error(f'Missing taridx file {pylst}')
             return
+
+        # the whole index comes from the binary index
+        if idx_start == 0 and idx_end == -1:
+            index = cls.load_binary_index(namespace)
+            index = index[index['size'] >= 0]
+            data = np.stack([np.char.decode(index['name'], 'utf-8'),
+                             index['offset'].astype(str), index['size'].astype(str)], axis=1)
+            LOGGER.debug(f'Found {data.shape[0]} unique entries')
+            return data
+
         with open(pylst) as f:
             if idx_end == -1:
                 data = np.genfromtxt(f, delimiter=',', comments=None,
@@ -178,7 +261,409 @@ class IO_Tar (IO_Base):
 
         _, uindices = np.unique(data[:, 0], return_index=True)
         data = data[uindices]
+        data = data[data[:, 2] != '-1']
         LOGGER.debug(f'Found {data.shape[0]} unique entries')
         return data
 
+    @classmethod
+    def load_binary_index(cls, namespace):
+        # returns the members of the archive as a structured array of
+        # (name, offset, size), sorted by name, with the latest entry of each
+        # name. it is kept (memory-mapped) in namespace.pyidx, and brought up
+        # to date from the lines appended to the .pylst since it was written
+        namespace = check_extn(namespace, '.tar')
+        pylst, pyidx = f'{namespace}.pylst', f'{namespace}.pyidx'
+
+        cls._recover_compact(namespace)
+        index, pos, ino = cls._read_binary_index(namespace)
+        lst = os.stat(pylst)
+        if pos == lst.st_size and ino == lst.st_ino:
+            return index
+
+        try:
+            with FileLock(f'{pyidx}.lock'):
+                index, pos, ino = cls._read_binary_index(namespace)
+                index, pos, ino = cls._update_binary_index(namespace, index, pos, ino)
+                cls._write_binary_index(namespace, index, pos, ino)
+            return np.load(pyidx, mmap_mode='r')
+
+        # e.g., read-only archives
+        except OSError as e:
+            LOGGER.debug(f'Failed to save the binary index of ({namespace}): {e}')
+            return cls._update_binary_index(namespace, index, pos, ino)[0]
+
+    @classmethod
+    def lookup_index(cls, namespace, keys):
+        # returns the offsets and sizes of keys in the archive (both -1 if
+        # missing, and size -1 if deleted)
+        return cls._lookup(cls.load_binary_index(namespace), keys)[:2]
+
+    @classmethod
+    def compact(cls, namespace):
+        # rewrites the archive with only the latest entry of each live key,
+        # one member at a time, and renames it (and its index) into place.
+        # the renames are not atomic together, so the new archive is marked
+        # complete first, and an interrupted swap is finished by the next
+        # reader or writer (see _recover_compact).
+        # returns the number of bytes reclaimed
+        namespace = check_extn(namespace, '.tar')
+        # (IO_TarSharded reads its shards through here)
+        if not IO_Tar.namespace_exists(namespace):
+            return 0
+
+        tmp = cls._compact_path(namespace)
+        cls._recover_compact(namespace)
+        with cls._write_lock(namespace):
+            index = cls.load_binary_index(namespace)
+            index = index[index['size'] >= 0]
+            index = index[np.argsort(index['offset'])]
+
+            # the files of a compaction interrupted before it was complete
+            for extn in cls._COMPACT_EXTNS + ['.pyidx.lock']:
+                if os.path.exists(tmp + extn):
+                    os.remove(tmp + extn)
+            with open(namespace, 'rb') as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with cls._open(tmp, 'r+') as tf:
+                    for name, offset, size in zip(index['name'].tolist(),
+                                                  index['offset'].tolist(), index['size'].tolist()):
+                        tf.write(name.decode('utf-8'), mm[offset:offset + size])
+            finally:
+                mm.close()
+            cls.close_handles(tmp)
+            cls.load_binary_index(tmp)
+
+            size = os.path.getsize(namespace)
+            with cls._swap_lock(namespace, exclusive=True), FileLock(f'{namespace}.pyidx.lock'):
+                open(f'{tmp}.ready', 'w').close()
+                cls._swap_compacted(namespace)
+
+        reclaimed = size - os.path.getsize(namespace)
+        LOGGER.info(f'Compacted ({namespace}) to {index.shape[0]} keys, reclaiming {reclaimed} bytes')
+        return reclaimed
+
+    @classmethod
+    def close_handles(cls, namespace=None):
+        # closes the pooled handles of namespace (or of all archives)
+        with IO_Tar._HANDLES_LOCK:
+            keys = [k for k in IO_Tar._HANDLES if namespace is None or k[0] == namespace]
+            entries = [IO_Tar._HANDLES.pop(k) for k in keys]
+        for tf, _ in entries:
+            cls._close(tf)
+
+    # --------------------------------------------------------------------------
+    # IO_Tar Private Functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    @contextmanager
+    def _open(cls, namespace, mode):
+        # takes a handle out of the pool (or opens one), and returns it to the
+        # pool after use. threads using the same archive at once get their own
+        # handles, since a handle cannot be shared
+        key = (namespace, mode)
+        stat = cls._stat(namespace)
+        with IO_Tar._HANDLES_LOCK:
+            entry = IO_Tar._HANDLES.pop(key, None)
+
+        if entry is not None and entry[1] == stat:
+            tf = entry[0]
+        else:
+            if entry is not None:
+                cls._close(entry[0])
+            tf = IndexedTarFile()
+            tf.open(namespace, mode)
+            if mode == 'r+':
+                # the default (pax) format adds a header for the float mtime
+                # pytaridx sets, which shifts the data from the indexed offset
+                tf.tfa.format = tarfile.GNU_FORMAT
+
+        try:
+            yield tf
+        except BaseException:
+            cls._close(tf)
+            raise
+
+        # our own writes do not make the handle stale
+        if mode == 'r+':
+            stat = cls._stat(namespace)
+
+        evicted = []
+        with IO_Tar._HANDLES_LOCK:
+            if key in IO_Tar._HANDLES or cls.MAX_HANDLES <= 0:
+                evicted.append(tf)
+            else:
+                IO_Tar._HANDLES[key] = (tf, stat)
+            while len(IO_Tar._HANDLES) > cls.MAX_HANDLES:
+                evicted.append(IO_Tar._HANDLES.popitem(last=False)[1][0])
+        for _ in evicted:
+            cls._close(_)
+
+    @classmethod
+    def _write_lock(cls, namespace):
+        # held while an archive is written to
+        return FileLock(f'{namespace}.lock')
+
+    @classmethod
+    def _write_members(cls, namespace, filenames, data):
+        with cls._open(namespace, 'r+') as tf:
+            for i, fname in enumerate(filenames):
+                d = cls._encode(data[i])
+                with io.BytesIO() as stream:
+                    stream.write(d)
+                    tf.write(fname, stream.getvalue())
+
+    @classmethod
+    def _write_tombstones(cls, namespace, filenames):
+        # tombstones are entries of size -1 at the end of the archive
+        with cls._open(namespace, 'r+') as tf:
+            end = os.path.getsize(namespace)
+            for fname in filenames:
+                tf.index.insert(fname, end, -1)
+            # the tar itself is not written, so mark it as changed for the
+            # pooled handles of other processes
+            os.utime(namespace)
+
+    @classmethod
+    @contextmanager
+    def _swap_lock(cls, namespace, exclusive):
+        # held (shared) while an archive and its index are read together, and
+        # (exclusive) while compact swaps them. an archive that does not exist
+        # has nothing to swap, so gets no lock file either
+        if not os.path.isfile(namespace):
+            yield
+            return
+        try:
+            fp = open(f'{namespace}.swap.lock', 'a')
+        except OSError:
+            yield   # e.g., read-only archives, which are not compacted either
+            return
+        with fp:
+            fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+            # compact holds the exclusive lock until its swap is done, so a
+            # swap left to do was interrupted
+            if not exclusive and os.path.exists(f'{cls._compact_path(namespace)}.ready'):
+                fcntl.flock(fp, fcntl.LOCK_UN)
+                cls._recover_compact(namespace)
+                fcntl.flock(fp, fcntl.LOCK_SH)
+            yield
+
+    @classmethod
+    def _compact_path(cls, namespace):
+        # the archive that compact writes, hidden next to namespace
+        dirname, basename = os.path.split(namespace)
+        return os.path.join(dirname, f'.{basename}.compact.tar')
+
+    @classmethod
+    def _recover_compact(cls, namespace):
+        # finishes the swap of a compaction that was interrupted after its
+        # archive was complete (marked by .ready). until then, the .pylst and
+        # the archive may not match
+        if not os.path.exists(f'{cls._compact_path(namespace)}.ready'):
+            return
+        with cls._write_lock(namespace), cls._swap_lock(namespace, exclusive=True), \
+                FileLock(f'{namespace}.pyidx.lock'):
+            cls._swap_compacted(namespace)
+
+    @classmethod
+    def _swap_compacted(cls, namespace):
+        # renames the complete compacted archive into place. called with the
+        # write lock, the exclusive swap lock, and the .pyidx lock held, and
+        # safe to repeat if interrupted
+        tmp = cls._compact_path(namespace)
+        if not os.path.exists(f'{tmp}.ready'):
+            return
+        LOGGER.debug(f'Swapping the compacted ({namespace}) into place')
+        cls.close_handles(namespace)
+        for extn in cls._COMPACT_EXTNS:
+            if os.path.exists(tmp + extn):
+                os.replace(tmp + extn, namespace + extn)
+        if os.path.exists(f'{tmp}.pyidx.lock'):
+            os.remove(f'{tmp}.pyidx.lock')
+        os.remove(f'{tmp}.ready')
+
+    @classmethod
+    def _match_index(cls, index, keypattern):
+        # returns the entries of index whose names match keypattern
+
+        # the index is sorted, so only the names that start with the literal
+        # prefix of the pattern need to be matched
+        prefix = re.split(r'[*?[]', keypattern, maxsplit=1)[0].encode('utf-8')
+        if len(prefix) > 0:
+            index = index[np.searchsorted(index['name'], prefix, 'left'):
+                          np.searchsorted(index['name'], prefix + b'\xff', 'left')]
+
+        if keypattern.encode('utf-8') == prefix + b'*':
+            return index
+        match = re.compile(fnmatch.translate(keypattern).encode('utf-8')).match
+        return index[np.array([match(n) is not None for n in index['name'].tolist()], dtype=bool)]
+
+    @classmethod
+    def _lookup(cls, index, keys):
+        # returns the offsets, sizes, and .pylst positions of the entries of
+        # keys in index (all -1 if missing)
+        names = np.array([k.encode('utf-8') for k in keys], dtype=bytes)
+        offsets, sizes, lines = (np.full(len(keys), -1, dtype=np.int64) for _ in range(3))
+        if index.shape[0] == 0 or len(keys) == 0:
+            return offsets, sizes, lines
+
+        idxs = np.minimum(np.searchsorted(index['name'], names), index.shape[0] - 1)
+        found = index['name'][idxs] == names
+        offsets[found] = index['offset'][idxs[found]]
+        sizes[found] = index['size'][idxs[found]]
+        lines[found] = index['line'][idxs[found]]
+        return offsets, sizes, lines
+
+    @classmethod
+    def _read_binary_index(cls, namespace):
+        # returns the saved index, the position in the .pylst up to which it
+        # is complete, and the inode of that .pylst
+        pyidx = f'{namespace}.pyidx'
+        try:
+            # read the position first, so the index covers at least as much
+            with open(f'{pyidx}.pos') as fp:
+                pos, ino = (int(_) for _ in fp.read().split())
+            index = np.load(pyidx, mmap_mode='r')
+            if index.dtype.names == cls._index_dtype(1).names:
+                return index, pos, ino
+        except (FileNotFoundError, ValueError):
+            pass
+        # e.g., an index saved without the positions of the entries
+        return np.empty(0, dtype=cls._index_dtype(1)), 0, -1
+
+    @classmethod
+    def _update_binary_index(cls, namespace, index, pos, ino):
+        with open(f'{namespace}.pylst', 'rb') as fp:
+            # a new (e.g., regenerated) list is read from the start
+            stat = os.fstat(fp.fileno())
+            if stat.st_ino != ino or stat.st_size < pos:
+                index, pos, ino = np.empty(0, dtype=cls._index_dtype(1)), 0, stat.st_ino
+            fp.seek(pos)
+            tail = fp.read()
+
+        # skip a line that is still being written
+        tail = tail[:tail.rfind(b'\n') + 1]
+        start, pos = pos, pos + len(tail)
+        if len(tail) == 0:
+            return index, pos, ino
+
+        nlines = tail.count(b'\n')
+        fields = tail.replace(b'\n', b',').split(b',')[:-1]
+        if b'\\' not in tail and len(fields) == 3 * nlines:
+            # no escaped names, so every line has exactly three fields
+            fields = np.array(fields).reshape(-1, 3)
+            new = np.empty(nlines, dtype=cls._index_dtype(fields.dtype.itemsize))
+            new['name'] = fields[:, 0]
+            new['offset'] = fields[:, 1].astype(np.int64)
+            new['size'] = fields[:, 2].astype(np.int64)
+            ends = np.flatnonzero(np.frombuffer(tail, dtype=np.uint8) == ord('\n'))
+            new['line'] = start + np.append(0, ends[:-1] + 1)
+        else:
+            entries = []
+            for line in tail.split(b'\n')[:-1]:
+                try:
+                    name, offset, size = line.rsplit(b',', 2)
+                    entries.append((re.sub(rb'\\(.)', rb'\1', name), int(offset), int(size), start))
+                except ValueError:
+                    LOGGER.warning(f'Skipping corrupt entry in ({namespace}.pylst): {line}')
+                start += len(line) + 1
+            if len(entries) == 0:
+                return index, pos, ino
+            new = np.array(entries, dtype=cls._index_dtype(max(len(e[0]) for e in entries)))
+
+        # sort by name, and keep the last entry of each name, as pytaridx does
+        new = new[np.argsort(new['name'], kind='stable')]
+        new = new[np.append(new['name'][1:] != new['name'][:-1], True)]
+
+        if index.shape[0] > 0:
+            width = max(index.dtype['name'].itemsize, new.dtype['name'].itemsize)
+            new = new.astype(cls._index_dtype(width))
+            index = index[~np.isin(index['name'], new['name'])].astype(new.dtype)
+            new = np.concatenate([index, new])
+            new = new[np.argsort(new['name'], kind='stable')]
+        LOGGER.debug(f'Indexed {nlines} new entries of ({namespace})')
+        return new, pos, ino
+
+    @classmethod
+    def _write_binary_index(cls, namespace, index, pos, ino):
+        pyidx = f'{namespace}.pyidx'
+        dirname = os.path.dirname(pyidx) or '.'
+
+        # replace the index, then the position, so readers never see a
+        # position beyond the index
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp', suffix='.npy')
+        with os.fdopen(fd, 'wb') as fp:
+            np.save(fp, np.ascontiguousarray(index))
+        os.replace(tmp, pyidx)
+
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(f'{pos} {ino}')
+        os.replace(tmp, f'{pyidx}.pos')
+
+    @classmethod
+    def _index_dtype(cls, width):
+        # line is the position of the entry in the .pylst
+        return np.dtype([('name', f'S{width}'), ('offset', '<i8'), ('size', '<i8'),
+                         ('line', '<i8')])
+
+    @classmethod
+    def _read_mapped(cls, mm, locations):
+        # returns the (offset, size) locations of mm in the given order
+        order = sorted(range(len(locations)), key=lambda i: locations[i][0])
+
+        # ask for the coalesced ranges up front, so the kernel reads them in
+        # large requests while we copy
+        if hasattr(mm, 'madvise'):
+            start, end = None, None
+            for i in order + [None]:
+                offset, size = (None, None) if i is None else locations[i]
+                if start is not None and (i is None or offset > end + cls.READ_GAP):
+                    aligned = start - start % mmap.PAGESIZE
+                    mm.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+                    start = None
+                if i is not None:
+                    start = offset if start is None else start
+                    end = offset + size
+
+        data = [None] * len(locations)
+        if cls.ZERO_COPY:
+            view = memoryview(mm)
+            for i in order:
+                offset, size = locations[i]
+                data[i] = view[offset:offset + size]
+        else:
+            for i in order:
+                offset, size = locations[i]
+                data[i] = mm[offset:offset + size]
+            mm.close()
+        return data
+
+    @classmethod
+    def _stat(cls, namespace):
+        # the index is written after the data, so check both
+        try:
+            s, t = os.stat(namespace), os.stat(f'{namespace}.pytree')
+            return s.st_ino, s.st_size, s.st_mtime_ns, t.st_size, t.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def _close(cls, tf):
+        try:
+            tf.close()
+        except Exception as e:
+            LOGGER.warning(f'Failed to close ({tf.filename}): {e}')
+
+    @classmethod
+    def _reset_handles(cls):
+        # open files are shared with the parent, so children open their own
+        IO_Tar._HANDLES = OrderedDict()
+        IO_Tar._HANDLES_LOCK = threading.Lock()
+
+
+atexit.register(IO_Tar.close_handles)
+os.register_at_fork(after_in_child=IO_Tar._reset_handles)
+
 # ------------------------------------------------------------------------------
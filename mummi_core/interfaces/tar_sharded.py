@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2021, Lawrence Livermore National Security, LLC. All rights
+# reserved. LLNL-CODE-827197. This work was produced at the Lawrence Livermore
+# National Laboratory (LLNL) under contract no. DE-AC52-07NA27344 (Contract 44)
+# between the U.S. Department of Energy (DOE) and Lawrence Livermore National
+# Security, LLC (LLNS) for the operation of LLNL.  See license for disclaimers,
+# notice of U.S. Government Rights and license terms and conditions.
+# -----------------------------------------------------------------------------
+
+import os
+import glob
+import mmap
+import time
+import tempfile
+import threading
+import itertools
+import numpy as np
+from logging import getLogger
+from contextlib import contextmanager
+from filelock import FileLock, Timeout
+
+from .tar import IO_Tar
+
+LOGGER = getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+# Sharded Tar Interface
+# the namespace is a directory of tar archives, read as one namespace:
+#   shard-XXX.tar   written by one process at a time (under a file lock)
+#   merged-XXX.tar  written by compact, from older shards
+# every write takes the next sequence number of the namespace (from .seq),
+# which is recorded in the .pyseq of the archive, against the position in the
+# .pylst where its entries start. a key found in several archives is read from
+# the entry with the highest sequence, unless that entry is a tombstone
+# ------------------------------------------------------------------------------
+class IO_TarSharded (IO_Tar):
+
+    # number of writer shards, i.e., of processes that can write at once
+    SHARDS = 8
+
+    # compact merges the writer shards, and the newest merged archives that are
+    # smaller than COMPACT_SIZE bytes, into one new merged archive
+    COMPACT_SIZE = 1 << 30
+
+    # background compactors {namespace: (thread, stop event)}
+    _COMPACTORS = {}
+
+    # --------------------------------------------------------------------------
+    # Public Abstract functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    def get_type(cls):
+        return 'taridx-sharded'
+
+    @classmethod
+    def file_exists(cls, namespace, key):
+        assert isinstance(namespace, str) and isinstance(key, str)
+        return cls.files_exist(namespace, [key])[0]
+
+    @classmethod
+    def files_exist(cls, namespace, keys):
+        assert isinstance(namespace, str) and isinstance(keys, list)
+
+        # the latest entry of a key decides
+        sizes = cls._resolve(namespace, keys)[2]
+        return [bool(s >= 0) for s in sizes]
+
+    @classmethod
+    def namespace_exists(cls, namespace):
+        assert isinstance(namespace, str)
+        return len(cls._get_shards(namespace)) > 0
+
+    # --------------------------------------------------------------------------
+    # Private Abstract functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    def _list_keys(cls, namespace, keypattern, max_keys=None, offset=0):
+
+        names, seqs, sizes = [], [], []
+        for shard in cls._get_shards(namespace):
+            try:
+                index = cls._match_index(cls.load_binary_index(shard), keypattern)
+                seqs.append(cls._line_seqs(shard, index['line']))
+            except FileNotFoundError:
+                continue
+            names.append(index['name'])
+            sizes.append(index['size'])
+        if len(names) == 0:
+            return []
+
+        # sort the entries by name and sequence, and keep the latest of each
+        names, seqs, sizes = np.concatenate(names), np.concatenate(seqs), np.concatenate(sizes)
+        if names.shape[0] == 0:
+            return []
+        order = np.lexsort((seqs, names))
+        names, sizes = names[order], sizes[order]
+        latest = np.append(names[1:] != names[:-1], True)
+        names = names[latest][sizes[latest] >= 0]
+
+        end = None if max_keys is None else offset + max_keys
+        return [n.decode('utf-8') for n in names[offset:end].tolist()]
+
+    @classmethod
+    def _load_files_partial(cls, namespace, filenames):
+
+        # a compaction can remove a shard after its entries were resolved,
+        # but they are then in a merged archive that the next listing includes
+        for attempt in range(3):
+            shards, _, sizes, owners = cls._resolve(namespace, filenames)
+            data = [None] * len(filenames)
+            try:
+                for i, shard in enumerate(shards):
+                    idxs = np.flatnonzero((owners == i) & (sizes >= 0)).tolist()
+                    if len(idxs) == 0:
+                        continue
+                    sdata = super()._load_files_partial(shard, [filenames[j] for j in idxs])
+                    for j, d in zip(idxs, sdata):
+                        data[j] = d
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+        LOGGER.debug(f'Loaded {sum(d is not None for d in data)} out of {len(filenames)} ' +
+                     f'keys from {len(np.unique(owners[owners >= 0]))} shards of ({namespace})')
+        return data
+
+    @classmethod
+    def _save_files(cls, namespace, filenames, data):
+
+        try:
+            os.makedirs(namespace, exist_ok=True)
+            with cls._lock_shard(namespace) as shard:
+                cls._append_seq(shard, cls._next_seq(namespace))
+                cls._write_members(shard, filenames, data)
+            LOGGER.debug(f'Wrote {len(filenames)} files to ({shard})')
+            return True
+        except Exception as e:
+            LOGGER.error(f'Failed to save files: {e}')
+            return False
+
+    @classmethod
+    def _remove_files(cls, namespace, filenames):
+
+        # tombstones hide the earlier entries of the keys, in any archive
+        if not cls.namespace_exists(namespace):
+            return [False] * len(filenames)
+
+        removed = cls.files_exist(namespace, filenames)
+        if any(removed):
+            with cls._lock_shard(namespace) as shard:
+                cls._append_seq(shard, cls._next_seq(namespace))
+                cls._write_tombstones(shard, [f for f, r in zip(filenames, removed) if r])
+        LOGGER.debug(f'Deleted {sum(removed)} out of {len(filenames)} keys in ({namespace})')
+        return removed
+
+    # --------------------------------------------------------------------------
+    # IO_TarSharded Specific Functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    def compact(cls, namespace):
+        # merges shards into a new merged archive, with only the latest entry
+        # of each key, and removes them. shards that are being written to are
+        # left for the next compaction. returns the number of bytes reclaimed,
+        # as IO_Tar.compact does
+        try:
+            with FileLock(os.path.join(namespace, '.compact.lock')).acquire(timeout=0):
+                return cls._compact(namespace)
+        except Timeout:
+            LOGGER.debug(f'({namespace}) is being compacted by another process')
+            return 0
+
+    @classmethod
+    def start_compactor(cls, namespace, interval=600):
+        # compacts namespace every interval seconds in a background thread
+        if namespace in IO_TarSharded._COMPACTORS:
+            return
+
+        stop = threading.Event()
+
+        def _run():
+            while not stop.wait(interval):
+                try:
+                    cls.compact(namespace)
+                except Exception as e:
+                    LOGGER.error(f'Failed to compact ({namespace}): {e}')
+
+        thread = threading.Thread(target=_run, daemon=True, name=f'compactor-{namespace}')
+        IO_TarSharded._COMPACTORS[namespace] = (thread, stop)
+        thread.start()
+
+    @classmethod
+    def stop_compactor(cls, namespace):
+        thread, stop = IO_TarSharded._COMPACTORS.pop(namespace, (None, None))
+        if thread is not None:
+            stop.set()
+            thread.join()
+
+    # --------------------------------------------------------------------------
+    # IO_TarSharded Private Functions
+    # --------------------------------------------------------------------------
+    @classmethod
+    def _get_shards(cls, namespace):
+        # returns the merged archives, then the writer shards
+        merged = sorted(glob.glob(os.path.join(namespace, 'merged-*.tar')))
+        shards = sorted(glob.glob(os.path.join(namespace, 'shard-*.tar')))
+        return merged + shards
+
+    @classmethod
+    def _resolve(cls, namespace, keys):
+        # returns the archives of namespace, and the sequence and size of the
+        # latest entry of each key, with the archive it is in (all -1 if the
+        # key has no entry)
+        for _ in range(3):
+            shards = cls._get_shards(namespace)
+            seqs, sizes, owners = (np.full(len(keys), -1, dtype=np.int64) for _ in range(3))
+            for i, shard in enumerate(shards):
+                try:
+                    offsets, ssizes, lines = cls._lookup(cls.load_binary_index(shard), keys)
+                    sseqs = cls._line_seqs(shard, lines)
+                except FileNotFoundError:
+                    continue    # compacted in the meantime
+                newer = (offsets >= 0) & (sseqs > seqs)
+                seqs[newer], sizes[newer], owners[newer] = sseqs[newer], ssizes[newer], i
+
+            # a key can be missed while its shards are merged, so check that
+            # the archives did not change
+            if np.all(owners >= 0) or shards == cls._get_shards(namespace):
+                break
+        return shards, seqs, sizes, owners
+
+    @classmethod
+    def _next_seq(cls, namespace):
+        # returns the next sequence number of namespace
+        path = os.path.join(namespace, '.seq')
+        with FileLock(f'{path}.lock'):
+            try:
+                with open(path) as fp:
+                    seq = int(fp.read()) + 1
+            except (FileNotFoundError, ValueError):
+                # e.g., a namespace written before sequences were kept
+                seqs = [cls._read_seqs(_)[:, 1] for _ in glob.glob(os.path.join(namespace, '*.tar'))]
+                seq = max((int(_.max()) for _ in seqs if _.shape[0] > 0), default=0) + 1
+
+            fd, tmp = tempfile.mkstemp(dir=namespace, prefix='.tmp')
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(str(seq))
+            os.replace(tmp, path)
+        return seq
+
+    @classmethod
+    def _append_seq(cls, shard, seq):
+        # records that the entries written to shard from now on have sequence
+        # seq. called while the shard is locked
+        try:
+            pos = os.path.getsize(f'{shard}.pylst')
+        except FileNotFoundError:
+            pos = 0
+        fd = os.open(f'{shard}.pyseq', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, np.array([pos, seq], dtype='<i8').tobytes())
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _read_seqs(cls, shard):
+        # returns the (position in the .pylst, sequence) records of shard
+        try:
+            seqs = np.fromfile(f'{shard}.pyseq', dtype='<i8')
+        except FileNotFoundError:
+            if not os.path.exists(shard):
+                raise
+            seqs = np.empty(0, dtype='<i8')   # e.g., regenerated
+        return seqs[:seqs.shape[0] // 2 * 2].reshape(-1, 2)
+
+    @classmethod
+    def _line_seqs(cls, shard, lines):
+        # returns the sequences of the entries at the given .pylst positions
+        # (0 for entries without a record)
+        records = cls._read_seqs(shard)
+        lines = np.asarray(lines, dtype=np.int64)
+        if records.shape[0] == 0:
+            return np.zeros(lines.shape[0], dtype=np.int64)
+        idxs = np.searchsorted(records[:, 0], lines, 'right') - 1
+        return np.where(idxs >= 0, records[np.maximum(idxs, 0), 1], 0)
+
+    @classmethod
+    def _get_shard_path(cls, namespace, i):
+        return os.path.join(namespace, f'shard-{i:03d}.tar')
+
+    @classmethod
+    @contextmanager
+    def _lock_shard(cls, namespace):
+        # yields the path of a shard locked for writing: the first free one,
+        # starting at one that depends on the process
+        first = os.getpid() % cls.SHARDS
+        for i in range(cls.SHARDS):
+            shard = cls._get_shard_path(namespace, (first + i) % cls.SHARDS)
+            lock = cls._write_lock(shard)
+            try:
+                lock.acquire(timeout=0)
+                break
+            except Timeout:
+                lock = None
+
+        if lock is None:
+            shard = cls._get_shard_path(namespace, first)
+            lock = cls._write_lock(shard)
+            lock.acquire()
+
+        try:
+            yield shard
+        finally:
+            lock.release()
+
+    @classmethod
+    def _compact(cls, namespace):
+
+        merged = sorted(glob.glob(os.path.join(namespace, 'merged-*.tar')))
+        small = []
+        for m in reversed(merged):
+            if os.path.getsize(m) >= cls.COMPACT_SIZE:
+                break
+            small.insert(0, m)
+
+        # keep the writer shards locked until they are removed
+        locks, shards = [], []
+        archives = cls._get_shards(namespace)
+        for shard in archives[len(merged):]:
+            lock = cls._write_lock(shard)
+            try:
+                lock.acquire(timeout=0)
+                locks.append(lock)
+                shards.append(shard)
+            except Timeout:
+                pass
+
+        try:
+            sources = small + shards
+            if len(sources) == 0 or (len(sources) == 1 and len(shards) == 0):
+                return 0
+
+            # the latest entry of each key, by sequence
+            latest = {}
+            for source in sources:
+                index = cls.load_binary_index(source)
+                seqs = cls._line_seqs(source, index['line'])
+                for name, offset, size, seq in zip(index['name'].tolist(), index['offset'].tolist(),
+                                                   index['size'].tolist(), seqs.tolist()):
+                    if name not in latest or latest[name][3] < seq:
+                        latest[name] = (source, offset, size, seq)
+
+            # tombstones are needed only while older archives remain
+            if len(sources) == len(archives):
+                latest = {k: v for k, v in latest.items() if v[2] >= 0}
+
+            # write the new archive next to the others, but hidden from them
+            # until all its files are in place. leftovers of a compaction that
+            # did not finish are removed first
+            for f in glob.glob(os.path.join(namespace, '.merged-*')):
+                os.remove(f)
+            size = sum(os.path.getsize(_) for _ in sources)
+            target = os.path.join(namespace, f'merged-{time.time_ns()}.tar')
+            if len(latest) > 0:
+                tmp = os.path.join(namespace, f'.{os.path.basename(target)}')
+                cls._merge(tmp, latest)
+                cls.close_handles(tmp)
+                for extn in ['.pylst', '.pytree', '.pyseq', '']:
+                    os.replace(tmp + extn, target + extn)
+
+            # entries are resolved by sequence, so a crash before the sources
+            # are removed leaves duplicates, but not stale values
+            for source in sources:
+                cls.close_handles(source)
+                for extn in ['', '.pylst', '.pytree', '.pyidx', '.pyidx.pos', '.pyseq',
+                             '.pyidx.lock', '.swap.lock']:
+                    try:
+                        os.remove(source + extn)
+                    except FileNotFoundError:
+                        pass
+
+            reclaimed = size - (os.path.getsize(target) if len(latest) > 0 else 0)
+            LOGGER.info(f'Compacted {len(sources)} archives of ({namespace}) into ' +
+                        f'({target}) with {len(latest)} keys, reclaiming {reclaimed} bytes')
+            return reclaimed
+
+        finally:
+            for lock in locks:
+                lock.release()
+
+    @classmethod
+    def _merge(cls, target, latest):
+        # copies the entries in latest into target in the order of their
+        # sequences (within a source, the order they are stored in), and
+        # records the sequences of target
+        entries = sorted((v[3], v[0], v[1], v[2], k) for k, v in latest.items())
+        mms = {}
+        try:
+            for source in {e[1] for e in entries if e[3] >= 0}:
+                with open(source, 'rb') as fp:
+                    mms[source] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+            with cls._open(target, 'r+') as tf:
+                for seq, group in itertools.groupby(entries, key=lambda e: e[0]):
+                    cls._append_seq(target, seq)
+                    for _, source, offset, size, name in group:
+                        if size >= 0:
+                            tf.write(name.decode('utf-8'), mms[source][offset:offset + size])
+                        else:
+                            tf.index.insert(name.decode('utf-8'), os.path.getsize(target), -1)
+        finally:
+            for mm in mms.values():
+                mm.close()
+
+    @classmethod
+    def regenerate_index(cls, filename):
+        # the sequences refer to positions in the old .pylst, so the entries
+        # of a regenerated shard count as older than any other
+        super().regenerate_index(filename)
+        if os.path.exists(f'{filename}.pyseq'):
+            os.remove(f'{filename}.pyseq')
+
+    @classmethod
+    def _reset_compactors(cls):
+        # threads do not survive a fork
+        IO_TarSharded._COMPACTORS = {}
+
+
+os.register_at_fork(after_in_child=IO_TarSharded._reset_compactors)
+
+# ------------------------------------------------------------------------------
@@ -11,7 +11,8 @@
 
 import os
 import time
-from typing import List, Callable
+import fnmatch
+from typing import List, Callable, Optional
 import multiprocessing as mp
 
 import mummi_core
@@ -87,4 +88,61 @@ def convert_interface_type(from_interface, to_interface, namespace, keypattern,
                  f'from ({from_interface}) to ({to_interface}), ' +
                  f'took {time.time() - init_time:.2f} seconds')
 
+
+# ------------------------------------------------------------------------------
+def tier_to_tar(namespace: str, archive: str, keypattern: str = '*',
+                min_idle: Optional[int] = None, consumed: Optional[str] = None,
+                batch_size: int = 1000):
+    # moves the keys of a redis namespace into a tar archive, and unlinks them
+    # from redis. a key is moved if it has not been accessed in min_idle
+    # seconds, or if it matches the consumed pattern (e.g., 'done-*' for keys
+    # renamed by move_key); with neither given, all keys are moved.
+    # readers that set IO_Redis.TIER_FALLBACK = True then find the moved keys
+    # in the archive.
+    # keys are assumed to be written once, and only one process should tier
+    # into a given archive at a time
+
+    init_time = time.time()
+    redis_io = mummi_core.get_io('redis')
+    tar_io = mummi_core.get_io('taridx')
+
+    # list the archive before any key leaves redis
+    redis_io.record_tier(namespace, archive)
+
+    counts = {}
+    for server in redis_io._get_all_servers():
+        conn = redis_io._get_remote_connection(server)
+        keys = list(redis_io.iter_keys_at_server(namespace, keypattern, server))
+
+        if min_idle is not None or consumed is not None:
+            idle = {}
+            if min_idle is not None:
+                for i in range(0, len(keys), batch_size):
+                    chunk = keys[i:i + batch_size]
+                    pipe = conn.pipeline(transaction=False)
+                    for k in chunk:
+                        pipe.object('idletime', redis_io._format_redis_key(namespace, k))
+                    idle.update(zip(chunk, pipe.execute(raise_on_error=False)))
+            keys = [k for k in keys
+                    if (consumed is not None and fnmatch.fnmatchcase(k, consumed))
+                    or (isinstance(idle.get(k), int) and idle[k] >= min_idle)]
+
+        counts[server] = 0
+        for i in range(0, len(keys), batch_size):
+            keys_to_data = redis_io._load_files_at_server(namespace, keys[i:i + batch_size], server)
+            chunk = list(keys_to_data.keys())
+            if len(chunk) == 0:
+                continue
+
+            # unlink only what has safely reached the archive
+            if not tar_io.save_files(archive, chunk,
+                                     [redis_io._decode(keys_to_data[k]) for k in chunk]):
+                LOGGER.error(f'Stopped tiering {namespace} at {server}')
+                break
+            counts[server] += len(redis_io.remove_files_at_server(namespace, chunk, server))
+
+    LOGGER.info(f'Moved {sum(counts.values())} keys of {namespace} to ({archive}), ' +
+                f'took {time.time() - init_time:.2f} seconds: {counts}')
+    return counts
+
 # ------------------------------------------------------------------------------
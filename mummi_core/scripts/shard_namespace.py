@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# -----------------------------------------------------------------------------
+# Copyright (c) 2021, Lawrence Livermore National Security, LLC. All rights
+# reserved. LLNL-CODE-827197. This work was produced at the Lawrence Livermore
+# National Laboratory (LLNL) under contract no. DE-AC52-07NA27344 (Contract 44)
+# between the U.S. Department of Energy (DOE) and Lawrence Livermore National
+# Security, LLC (LLNS) for the operation of LLNL.  See license for disclaimers,
+# notice of U.S. Government Rights and license terms and conditions.
+# -----------------------------------------------------------------------------
+
+import sys
+import argparse
+from logging import getLogger
+
+import mummi_core
+
+LOGGER = getLogger(__name__)
+
+
+# ------------------------------------------------------------------------------
+def main():
+
+    parser = argparse.ArgumentParser(prog='mummi_shard_namespace',
+                                     description='move the keys of flat IO_Simple '
+                                                 'namespaces into sharded subdirectories')
+    parser.add_argument('namespaces', nargs='+', help='namespace directories to convert')
+    namespaces = parser.parse_args(sys.argv[1:]).namespaces
+
+    mummi_core.init_logger()
+    io_simple = mummi_core.get_io('simple')
+    for namespace in namespaces:
+        io_simple.migrate_namespace(namespace)
+
+
+if __name__ == '__main__':
+    main()
+
+# ------------------------------------------------------------------------------
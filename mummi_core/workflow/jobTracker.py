@@ -294,13 +294,15 @@ class JobTracker:
         statuses = []
         for s in sim_names:
             flag_path = dir_sim(s)
-            if iointerface.test_signal(flag_path, flag_success):
+            # one directory read per simulation, for all the flags
+            found = iointerface.test_signals(flag_path, [flag_success, flag_failure, flag_stop])
+            if flag_success in found:
                 LOGGER.debug(f'[{job_type}] found ({flag_path})/({flag_success})')
                 statuses.append(SimulationStatus.Success)
-            elif iointerface.test_signal(flag_path, flag_failure):
+            elif flag_failure in found:
                 LOGGER.debug(f'[{job_type}] found ({flag_path})/({flag_failure})')
                 statuses.append(SimulationStatus.Failed)
-            elif iointerface.test_signal(flag_path, flag_stop):
+            elif flag_stop in found:
                 LOGGER.debug(f'[{job_type}] found ({flag_path})/({flag_stop})')
                 statuses.append(SimulationStatus.Stop)
             else:
@@ -5,7 +5,7 @@
 # ------------------------------------------------------------------------------
 
 import numpy as np
-import shutil, logging, sys, time, pickle, atexit
+import io, os, shutil, logging, sys, time, pickle, atexit
 
 import mummi_core
 from mummi_core.utils import timeout, Naming
@@ -47,6 +47,22 @@ def test_npz(iointerface=default_io):
         maxVal = max(maxVal, np.max(difference))
     print("Maximum difference read: {}".format(maxVal))
 
+    lazy = iointerface.load_npz('_test_io/file', 'key', lazy=True)
+    assert sorted(lazy) == sorted(arrays) and all(np.array_equal(lazy[k], arrays[k]) for k in arrays)
+
+    # arrays stored without compression are views of the buffer, in their own
+    # order; object arrays are unpickled instead
+    from mummi_core.interfaces.default_functions import read_npz_lazy
+    arrays = {'c': np.random.rand(4, 6), 'f': np.asfortranarray(np.random.rand(3, 5)),
+              'o': np.array([{'x': 1}, 'y', None], dtype=object)}
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    buffer = np.frombuffer(buffer.getvalue(), dtype=np.uint8)
+    lazy = read_npz_lazy(buffer)
+    assert all(np.array_equal(lazy[k], arrays[k]) for k in 'cf') and list(lazy['o']) == list(arrays['o'])
+    assert np.shares_memory(lazy['c'], buffer) and np.shares_memory(lazy['f'], buffer)
+    assert lazy['f'].flags.f_contiguous and not np.shares_memory(lazy['o'], buffer)
+
 
 def test_checkpoint(iointerface=default_io):
     if iointerface.get_type() != 'simple':
@@ -88,6 +104,386 @@ def test_heterogenous(iointerface=default_io):
     print(iointerface.load_files('_test_io/dir', ['testkey2', 'testkey3', 'testkey4']))
 
 
+def test_partial(iointerface=default_io):
+    print('TEST IO: partial')
+
+    iointerface.save_files('_test_io/dir', ['testkey5', 'testkey6'], ['testdata5', 'testdata6'])
+    data, missing = iointerface.load_files_partial('_test_io/dir', ['testkey5', 'badkey', 'testkey6'])
+    print(data, missing)
+    assert data == [b'testdata5', None, b'testdata6'] and missing == ['badkey']
+
+    # a namespace that does not exist has every key missing
+    data, missing = iointerface.load_files_partial('_test_io/nodir', ['testkey5', 'badkey'])
+    assert data == [None, None] and missing == ['testkey5', 'badkey']
+
+
+def test_remove(iointerface=default_io):
+    print('TEST IO: remove')
+
+    iointerface.save_files('_test_io/dir', ['testkey7', 'testkey8'], ['testdata7', 'testdata8'])
+    iointerface.remove_files('_test_io/dir', ['testkey7'])
+    data, missing = iointerface.load_files_partial('_test_io/dir', ['testkey7', 'testkey8'])
+    assert not iointerface.file_exists('_test_io/dir', 'testkey7') and missing == ['testkey7']
+    assert iointerface.files_exist('_test_io/dir', ['testkey7', 'testkey8']) == [False, True]
+
+    if hasattr(iointerface, 'compact'):
+        iointerface.compact('_test_io/dir')
+        assert iointerface.load_files('_test_io/dir', 'testkey8') == b'testdata8'
+
+
+def test_simple_sharded():
+    print('TEST IO: simple sharded')
+    iointerface = mummi_core.get_io('simple')
+
+    iointerface.save_files('_test_io/flat', ['testkey1', 'testkey2', 'testkey3'],
+                           ['testdata1', 'testdata2', 'testdata3'])
+
+    # hidden files stay, and keys already at their sharded path are not replaced
+    open('_test_io/flat/.hidden', 'w').close()
+    iointerface.SHARDED = True
+    iointerface.save_files('_test_io/flat', 'testkey3', 'newdata3')
+    iointerface.SHARDED = False
+    assert iointerface.migrate_namespace('_test_io/flat') == 2
+    assert sorted(f for f in os.listdir('_test_io/flat') if len(f) > 2) == ['.hidden', 'testkey3']
+
+    iointerface.SHARDED = True
+    try:
+        assert sorted(iointerface.list_keys('_test_io/flat', 'testkey*')) == ['testkey1', 'testkey2', 'testkey3']
+        iointerface.move_key('_test_io/flat', 'testkey1', suffix='')
+        assert iointerface.file_exists('_test_io/flat', 'done-testkey1')
+        assert iointerface.load_files('_test_io/flat', 'done-testkey1') == b'testdata1'
+        assert iointerface.load_files('_test_io/flat', 'testkey3') == b'newdata3'
+    finally:
+        iointerface.SHARDED = False
+
+
+def test_tar_binary_index():
+    print('TEST IO: tar binary index')
+    iointerface = mummi_core.get_io('taridx')
+    namespace = '_test_io/index.tar'
+
+    def check(index):
+        # the incremental index must match one built from scratch
+        full = iointerface._update_binary_index(namespace, index[:0], 0, -1)[0]
+        assert np.array_equal(np.asarray(index), full.astype(index.dtype))
+        with open(namespace + '.pylst', 'rb') as fp:
+            lines = fp.read()
+        for name, line in zip(index['name'].tolist(), index['line'].tolist()):
+            assert lines[line:].split(b'\n', 1)[0].rsplit(b',', 2)[0].replace(b'\\', b'') \
+                == name.replace(b'\\', b'')
+
+    iointerface.save_files(namespace, ['a', 'b'], ['data_a', 'data_b'])
+    assert iointerface.load_binary_index(namespace).shape[0] == 2
+
+    # lines appended after the first build, including escaped names
+    keys = ['c', 'a', 'with,comma', 'back\\slash']
+    iointerface.save_files(namespace, keys, ['data_c', 'data_a2', 'data_comma', 'data_slash'])
+    index = iointerface.load_binary_index(namespace)
+    check(index)
+    assert sorted(iointerface.list_keys(namespace, '*')) == sorted(set(['b'] + keys))
+    assert iointerface.load_files(namespace, keys) == [b'data_c', b'data_a2', b'data_comma', b'data_slash']
+    with open(namespace + '.pyidx.pos') as fp:
+        assert int(fp.read().split()[0]) == os.path.getsize(namespace + '.pylst')
+
+    # a new .pylst (another inode) is indexed from the start
+    for rebuild in [iointerface.compact, iointerface.regenerate_index]:
+        ino = os.stat(namespace + '.pylst').st_ino
+        rebuild(namespace)
+        assert os.stat(namespace + '.pylst').st_ino != ino
+        index = iointerface.load_binary_index(namespace)
+        check(index)
+        assert index.shape[0] == 5
+        assert iointerface.load_files(namespace, ['with,comma', 'b']) == [b'data_comma', b'data_b']
+
+
+def test_tar_list_keys():
+    print('TEST IO: tar list keys')
+    import fnmatch
+    keys = ['aa', 'ab1', 'ab10', 'ab2', 'abc', 'b1', 'sub/ab1']
+
+    for name in ['taridx', 'taridx-sharded']:
+        iointerface = mummi_core.get_io(name)
+        namespace = f'_test_io/list-{name}.tar'
+        iointerface.save_files(namespace, keys, [k.encode('utf-8') for k in keys])
+
+        # a literal prefix narrows the index before the pattern is matched
+        for pattern in ['ab*', 'ab?', 'ab[12]', 'ab[!c]*', '[ab]?', 'a*1', 'b*', 'c*']:
+            expected = [k for k in keys if fnmatch.fnmatchcase(k, pattern)]
+            assert iointerface._list_keys(namespace, pattern) == expected, pattern
+        assert iointerface.list_keys(namespace, 'ab?') == ['ab1', 'ab2', 'abc']
+
+        # pages are counted in full names, and basenames are listed once per page
+        pages = [iointerface.list_keys(namespace, '*', max_keys=3, offset=i) for i in range(0, 9, 3)]
+        assert pages == [['aa', 'ab1', 'ab10'], ['ab2', 'abc', 'b1'], ['ab1']]
+        assert iointerface.list_keys(namespace, '*ab1') == ['ab1']
+
+
+def test_simple_files_exist():
+    print('TEST IO: simple files exist')
+    iointerface = mummi_core.get_io('simple')
+
+    iointerface.save_files('_test_io/hidden', ['.hid', 'a'], ['data_hid', 'data_a'])
+    assert iointerface.file_exists('_test_io/hidden', '.hid')
+    assert iointerface.files_exist('_test_io/hidden', ['.hid', 'a', 'b']) == [True, True, False]
+    assert iointerface.test_signals('_test_io/hidden', ['.hid', 'b']) == {'.hid'}
+
+
+def test_simple_concurrent():
+    print('TEST IO: simple concurrent')
+    from unittest import mock
+    from mummi_core.interfaces.simple import IO_Simple
+
+    class IO_SimpleConcurrent(IO_Simple):
+        MAX_WORKERS = 4
+
+    keys = [f'key{i}' for i in range(20)]
+    IO_SimpleConcurrent.save_files('_test_io/concurrent', keys, [f'data{i}' for i in range(20)])
+
+    # the first keys are read last, but still come back in order
+    read = open
+    def slow(path, *args, **kwargs):
+        if '_test_io/concurrent/key' in path:
+            time.sleep(0.002 * (20 - int(path.rsplit('key', 1)[1])))
+        return read(path, *args, **kwargs)
+    with mock.patch('builtins.open', slow):
+        data, missing = IO_SimpleConcurrent.load_files_partial('_test_io/concurrent', keys + ['bad'])
+    assert data == [f'data{i}'.encode('utf-8') for i in range(20)] + [None] and missing == ['bad']
+
+
+def test_simple_fsync():
+    print('TEST IO: simple fsync')
+    from unittest import mock
+    from mummi_core.interfaces.simple import IO_Simple
+
+    class IO_SimpleSync(IO_Simple):
+        MAX_WORKERS = 1
+
+    # each file is synced before its rename, and its directory once per file
+    # ('file') or once per save ('batch')
+    keys = ['a', 'b', 'c']
+    for policy, nsyncs in [('none', 0), ('file', 6), ('batch', 4)]:
+        IO_SimpleSync.FSYNC = policy
+        with mock.patch('os.fsync') as fsync:
+            assert IO_SimpleSync.save_files('_test_io/fsync', keys, ['1', '2', '3'])
+        assert fsync.call_count == nsyncs, policy
+
+    IO_SimpleSync.FSYNC = 'always'
+    assert not IO_SimpleSync.save_files('_test_io/fsync', 'a', '4')
+
+    # a failed write leaves neither the file nor its temporary file
+    IO_SimpleSync.FSYNC = 'file'
+    with mock.patch('os.replace', side_effect=OSError('disk full')):
+        assert not IO_SimpleSync.save_files('_test_io/fsync', 'd', '5')
+    assert sorted(os.listdir('_test_io/fsync')) == keys
+    assert IO_SimpleSync.load_files('_test_io/fsync', keys) == [b'1', b'2', b'3']
+
+
+def first_shard_lock(iointerface, namespace):
+    # the lock of the first shard this process writes to. holding it steers
+    # the writes to another shard
+    from filelock import FileLock
+    os.makedirs(namespace, exist_ok=True)
+    return FileLock(iointerface._get_shard_path(namespace, os.getpid() % iointerface.SHARDS) + '.lock')
+
+
+def test_tar_sharded_order():
+    print('TEST IO: tar sharded order')
+    iointerface = mummi_core.get_io('taridx-sharded')
+    namespace = '_test_io/sharded_order'
+
+    first = first_shard_lock(iointerface, namespace)
+    with first:
+        iointerface.save_files(namespace, 'k', 'v1')
+    iointerface.save_files(namespace, 'k', 'v2')
+    with first:
+        iointerface.save_files(namespace, 'j', 'x')
+
+    assert iointerface.load_files(namespace, 'k') == b'v2'
+    assert iointerface.list_keys(namespace, '*') == ['j', 'k']
+    assert iointerface.compact(namespace) > 0
+    assert iointerface.load_files(namespace, 'k') == b'v2'
+
+
+def test_tar_sharded_remove_order():
+    print('TEST IO: tar sharded remove order')
+    iointerface = mummi_core.get_io('taridx-sharded')
+    namespace = '_test_io/sharded_remove'
+
+    first = first_shard_lock(iointerface, namespace)
+    iointerface.save_files(namespace, 'k', 'v1')
+    iointerface.remove_files(namespace, 'k')
+    with first:
+        iointerface.save_files(namespace, 'k', 'v3')
+    iointerface.save_files(namespace, 'j', 'x')
+
+    assert iointerface.file_exists(namespace, 'k')
+    assert iointerface.load_files_partial(namespace, ['k']) == ([b'v3'], [])
+    iointerface.compact(namespace)
+    assert iointerface.load_files_partial(namespace, ['k']) == ([b'v3'], [])
+
+
+def test_tar_sharded_compactor():
+    print('TEST IO: tar sharded compactor')
+    iointerface = mummi_core.get_io('taridx-sharded')
+    namespace = '_test_io/sharded_compactor'
+
+    with first_shard_lock(iointerface, namespace):
+        iointerface.save_files(namespace, 'k', 'v1')
+    iointerface.save_files(namespace, ['k', 'j'], ['v2', 'x'])
+
+    # the shards are merged in the background, and a second start is ignored
+    iointerface.start_compactor(namespace, interval=0.1)
+    iointerface.start_compactor(namespace, interval=0.1)
+    thread = iointerface._COMPACTORS[namespace][0]
+    for _ in range(50):
+        if not any(f.startswith('shard-') and f.endswith('.tar') for f in os.listdir(namespace)):
+            break
+        time.sleep(0.1)
+    iointerface.stop_compactor(namespace)
+    assert not thread.is_alive() and namespace not in iointerface._COMPACTORS
+    assert any(f.startswith('merged-') for f in os.listdir(namespace))
+    assert iointerface.load_files(namespace, ['k', 'j']) == [b'v2', b'x']
+
+    # once stopped, new shards are left alone
+    iointerface.save_files(namespace, 'i', 'y')
+    time.sleep(0.3)
+    assert any(f.startswith('shard-') and f.endswith('.tar') for f in os.listdir(namespace))
+    iointerface.stop_compactor(namespace)
+
+
+def test_tar_compact_recovery():
+    print('TEST IO: tar compact recovery')
+    from unittest import mock
+    iointerface = mummi_core.get_io('taridx')
+    namespace = '_test_io/recovery.tar'
+
+    iointerface.save_files(namespace, ['a', 'b', 'c'], ['data_a', 'data_b', 'data_c'])
+    iointerface.remove_files(namespace, ['a'])
+
+    # crash after the index, but not the archive, is swapped
+    replace = os.replace
+    calls = []
+    def crash(src, dst):
+        if '.compact.tar' in src:
+            calls.append(dst)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+        replace(src, dst)
+    with mock.patch('os.replace', crash):
+        try:
+            iointerface.compact(namespace)
+        except KeyboardInterrupt:
+            pass
+    iointerface.close_handles()
+
+    assert iointerface.load_files(namespace, ['b', 'c']) == [b'data_b', b'data_c']
+    assert not iointerface.file_exists(namespace, 'a')
+    assert calls[:2] == [namespace + '.pylst', namespace + '.pytree']
+    assert not any('.compact' in f for f in os.listdir('_test_io'))
+
+    # reading an archive that does not exist leaves no lock file behind
+    with iointerface._swap_lock('_test_io/none.tar', exclusive=False):
+        pass
+    assert iointerface.load_files_partial('_test_io/none.tar', ['a'])[0] == [None]
+    assert not any(f.startswith('none.tar') for f in os.listdir('_test_io'))
+
+
+def test_local_cache():
+    print('TEST IO: local cache')
+    from mummi_core.interfaces.cache import LocalCache
+
+    # the first put checks the total size, which is within the limit
+    cache = LocalCache('_test_io/cache', 1000)
+    cache.put({f'k{i}': bytes(100) for i in range(10)})
+    for i in range(10):
+        os.utime(cache._path(f'k{i}'), (i, i))
+    assert cache.written == 0 and len(cache.get(['k0'])) == 1
+
+    # the oldest entries (k0 was just used) are evicted down to 90%
+    cache.put({'k10': bytes(100)})
+    assert sorted(cache.get([f'k{i}' for i in range(11)])) == \
+        sorted(['k0'] + [f'k{i}' for i in range(3, 11)])
+    assert cache.written == 0
+
+    # the total is only checked again after a tenth of the cache is written
+    cache.put({'k11': bytes(50)})
+    assert cache.written == 50 and 'k11' in cache.get(['k11'])
+
+    cache.remove(['k11', 'missing'])
+    assert cache.get(['k11']) == {}
+
+    # a value fetched before a removal is not put back, but later fetches are
+    markers = cache.markers(['k12', 'k13'])
+    cache.remove(['k12'])
+    cache.put({'k12': bytes(10), 'k13': bytes(10)}, markers)
+    assert sorted(cache.get(['k12', 'k13'])) == ['k13']
+    cache.put({'k12': bytes(10)}, cache.markers(['k12']))
+    assert sorted(cache.get(['k12'])) == ['k12']
+
+
+def test_hash_ring():
+    print('TEST IO: hash ring')
+    try:
+        from mummi_core.interfaces.redis import HashRing
+    except ImportError:
+        print('redis is not installed')
+        return
+
+    keys = [f'ns::key_{i}' for i in range(4000)]
+    servers = [f'server{i}' for i in range(8)]
+    ring = HashRing(servers, 128)
+    owners = [ring.get_server(k) for k in keys]
+    reordered = HashRing(reversed(servers), 128)
+    assert owners == [reordered.get_server(k) for k in keys]
+    assert set(owners) == set(servers)
+
+    # adding a server only moves keys onto it, about 1/9 of them
+    bigger = HashRing(servers + ['server8'], 128)
+    moved = [k for k, o in zip(keys, owners) if bigger.get_server(k) != o]
+    print(f'{len(moved)} out of {len(keys)} keys moved')
+    assert all(bigger.get_server(k) == 'server8' for k in moved)
+    assert 0 < len(moved) < 2 * len(keys) / 9
+
+
+def test_redis_server_timeout():
+    print('TEST IO: redis server timeout')
+    try:
+        from mummi_core.interfaces.redis import IO_Redis
+    except ImportError:
+        print('redis is not installed')
+        return
+
+    class IO_RedisSlow(IO_Redis):
+        MAX_WORKERS = 2
+        SERVER_TIMEOUT = 1
+
+    def query(server):
+        time.sleep(2.5 if server == 'hung' else 0.6)
+        return server
+
+    # the third server waits for a thread, but still has its own second
+    results = IO_RedisSlow._map_servers(query, ['h1', 'h2', 'h3'])
+    assert results == {'h1': 'h1', 'h2': 'h2', 'h3': 'h3'}
+
+    # a server that takes too long once it runs is left out
+    results = IO_RedisSlow._map_servers(query, ['h1', 'hung', 'h2'])
+    assert results == {'h1': 'h1', 'h2': 'h2'}
+
+
+def test_codecs():
+    print('TEST IO: codecs')
+    from mummi_core.interfaces.codecs import compress, decompress, get_codecs
+
+    data = pickle.dumps({'a': list(range(1000))})
+    for codec in get_codecs():
+        cdata = compress(data, codec)
+        print(f'{codec}: {len(data)} --> {len(cdata)} bytes')
+        assert len(cdata) < len(data) and decompress(cdata) == data
+
+    assert compress(data, 'zlib', threshold=len(data)+1) == data
+    assert decompress(data) == data
+
+
 def cleanup():
     shutil.rmtree('_test_io', ignore_errors=True)
     print('Cleaning up tests')
@@ -99,8 +495,8 @@ if __name__ == '__main__':
 
     Naming.init()
 
-    for io in ['simple', 'taridx']:
-        iointerface = mummi_core.get_io(io)
+    for name in ['simple', 'taridx', 'taridx-sharded']:
+        iointerface = mummi_core.get_io(name)
 
         test_keys(iointerface)
         print_separator()
@@ -114,6 +510,38 @@ if __name__ == '__main__':
         print_separator()
         test_heterogenous(iointerface)
         print_separator()
+        test_partial(iointerface)
+        print_separator()
+        test_remove(iointerface)
+        print_separator()
+
+    test_simple_sharded()
+    print_separator()
+    test_tar_binary_index()
+    print_separator()
+    test_tar_list_keys()
+    print_separator()
+    test_simple_files_exist()
+    print_separator()
+    test_simple_concurrent()
+    print_separator()
+    test_simple_fsync()
+    print_separator()
+    test_tar_sharded_order()
+    print_separator()
+    test_tar_sharded_remove_order()
+    print_separator()
+    test_tar_sharded_compactor()
+    print_separator()
+    test_tar_compact_recovery()
+    print_separator()
+    test_codecs()
+    print_separator()
+    test_local_cache()
+    print_separator()
+    test_hash_ring()
+    print_separator()
+    test_redis_server_timeout()
 
 cleanup()
 atexit.register(cleanup)